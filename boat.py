@@ -1,17 +1,25 @@
 import sys
-import os
 import math
 import random
 import argparse
 import time
 import glob
 
+import startup   # Before pygame, so the startup trace covers the slow imports
 import pygame
 import opc
+import opc_udp
 
 from pprint import pprint
 
+import ramp
 import sound_board
+import events
+import output
+
+# The show, pipeline and asyncio control API are imported when they're
+# asked for.  Every import is time before first light.
+IMPORTED = time.perf_counter()
 
 # Commonly used type annotations
 Vector2 = tuple[int, int]
@@ -23,6 +31,11 @@ FADECANDY_HOST = 'localhost'
 FADECANDY_PORT = 7890
 TEMPORAL_DITHERING = True
 
+# Power to first light (ms).  The first frame goes to the LEDs before the
+# sounds and the display are loaded and we complain if it takes longer
+# than this.
+FIRST_LIGHT_BUDGET = 1500
+
 # Note: Modes are selected on a USB keypad.  Each mode should be K_KP*
 MODES_KEYS = {pygame.K_KP1: 'dragon',
               pygame.K_KP2: 'boat',
@@ -88,9 +101,22 @@ RATES = dict(boat=20,
 # How much the brightness is increased or decreased each step
 BRIGHT_STEP = 0.1
 
+# How long a brightness change takes (ms)
+BRIGHT_RAMP = 250
+
 # Time to fade out the lights and music when shutting down
 FADE_TIME = 1000
 
+# In pipeline mode the UI process only handles input, sound and the preview
+# so it can check for key presses more often than the animation runs (ms).
+PIPELINE_UI_WAIT = 20
+
+# How often the asyncio loop checks for key presses (ms)
+INPUT_POLL = 5
+
+# Colours for the fire burst light cue.  Picked at random every frame.
+FIRE_COLORS = [(255, 32, 0), (255, 96, 0), (255, 160, 0), (255, 220, 64), (128, 0, 0)]
+
 # This is a single LED object.  If I were to start fresh, I might not
 # do it this way but this let me develop/debug the boat and get it into
 # a working state.
@@ -150,9 +176,29 @@ class Boat:
         self.brightness = 1.0
         self.disco_delay = 0
 
+        # Brightness changes ramp instead of jumping.  Moved along once a
+        # frame by tick_levels().
+        self.levels = ramp.Ramps(brightness=self.brightness)
+
+        # Light cues from the sound board.  Times are on self.clock (ms).
+        self.clock = 0
+        self.flash_until = 0
+        self.fire_until = 0
+        self._revert = None     # (time, mode) to go back to after a mode cue
+
+        # Animation settings from the config, waiting for the next update()
+        self._settings = None
+        self._configured = set()
+
         self._mode = DEFAULT_MODE
         self.verbose = verbose
 
+        # Clicking and dragging over the LEDs in the window.  The hit index
+        # and the wiring map are only worked out on the first click.
+        self.brush = None
+        self._hits = None
+        self._wiring = None
+
     @property
     def mode(self) -> str:
         return self._mode
@@ -161,6 +207,58 @@ class Boat:
     def mode(self, value: str) -> None:
         self._mode = value
         self.disco_delay = 0
+        self._revert = None
+
+    # Handler for 'light_cue' events on the event bus.  This just sets up
+    # some state; the next update() does the actual work.
+    def cue(self, light: sound_board.LightCue) -> None:
+        until = self.clock + light.duration
+        if light.cue == 'flash':
+            self.flash_until = max(self.flash_until, until)
+        elif light.cue == 'fire':
+            self.fire_until = max(self.fire_until, until)
+        elif light.cue == 'mode':
+            previous = self._revert[1] if self._revert else self.mode
+            self.mode = light.mode
+            if light.duration:
+                self._revert = (until, previous)
+        if self.verbose:
+            print(f"Light cue: {light}")
+
+    # Animation settings (rail_level, rail_decay, rail_prob, wave_level)
+    # from the sound board config.  They take over from the class defaults
+    # at the start of the next frame.  Anything left out goes back to the
+    # default.
+    def configure(self, settings: dict) -> None:
+        self._settings = dict(settings)
+
+    def _apply_settings(self) -> None:
+        for name in self._configured - set(self._settings):
+            del self.__dict__[name]
+        for name, value in self._settings.items():
+            if name == 'rail_level':
+                value = (value, value, value)
+            setattr(self, name, value)
+        if self.verbose:
+            print(f"Animation settings: {self._settings}")
+        self._configured = set(self._settings)
+        self._settings = None
+
+    def tick_levels(self) -> None:
+        for name in self.levels.tick():
+            setattr(self, name, self.levels[name])
+
+    # Every LED colour in self.strips order.  Used to snapshot and restore
+    # whole frames (e.g. pre-rendered show segments).
+    @property
+    def pixels(self) -> list[ColorRGB]:
+        return [led.color for strip in self.strips for led in strip]
+
+    @pixels.setter
+    def pixels(self, colors: list[ColorRGB]) -> None:
+        leds = [led for strip in self.strips for led in strip]
+        for led, color in zip(leds, colors):
+            led.color = color
 
     @property
     def strands(self) -> list:
@@ -200,26 +298,59 @@ class Boat:
         
         return strands
 
-    def click(self, pos: Vector2) -> None:
-        # Only really useful in debug mode
-        for strip_ix, strip in enumerate(self.strips):
-            for led_ix, led in enumerate(strip):
-                if led.rect.collidepoint(pos):
-                    old = led.color
-                    new = (255, 255, 255) if old == (0, 0, 0) else (0, 0, 0)
-                    print(f"Strand{strip_ix}[{led_ix}]: {old} -> {new}")
-                    led.color = new
-                    return
+    def _hit_index(self):
+        if self._hits is None:
+            import diagnostic
+            self._hits = diagnostic.HitIndex(self.strips, LED_SIZE + LED_GAP)
+            self._wiring = {led: pixel for pixel, led in diagnostic.channel_map(self).items()}
+        return self._hits
+
+    def click(self, pos: Vector2) -> ColorRGB:
+        # Only really useful in debug mode.  Returns the colour the LED was
+        # toggled to so a drag can paint the same colour (see paint()).
+        hit = self._hit_index().hit(pos)
+        if hit is None:
+            return None
+        strip_ix, led_ix = hit
+        led = self.strips[strip_ix][led_ix]
+        old = led.color
+        new = (255, 255, 255) if old == (0, 0, 0) else (0, 0, 0)
+        pixel = self._wiring.get(hit)
+        where = f" (pixel {pixel}, strand {pixel // 64} offset {pixel % 64})" if pixel is not None else ''
+        print(f"Strand{strip_ix}[{led_ix}]{where}: {old} -> {new}")
+        led.color = new
+        return new
+
+    def paint(self, start: Vector2, end: Vector2, color: ColorRGB) -> None:
+        for strip_ix, led_ix in self._hit_index().line(start, end):
+            self.strips[strip_ix][led_ix].color = color
 
     def update(self, dt_ms: int) -> None:
         # The dt was only used on the space ship to control the speed
         # of the spinning nacelles.  Keeping it for now as we might
         # want it for the dragon.
         dt = dt_ms / 1e3
-        
+        self.clock += dt_ms
+
+        if self._settings is not None:
+            self._apply_settings()
+        self.tick_levels()
+
+        if self._revert and self.clock >= self._revert[0]:
+            self.mode = self._revert[1]
+
         # Run the currently selected animation routine.
         getattr(self, self.mode)()
-        
+
+        # Light cues go on top of whatever the animation did.
+        if self.clock < self.fire_until:
+            for led in self.kitt:
+                led.color = random.choice(FIRE_COLORS)
+        if self.clock < self.flash_until:
+            for strip in self.strips:
+                for led in strip:
+                    led.color = (255, 255, 255)
+
     def debug(self):
         pass
 
@@ -448,7 +579,40 @@ def parse_args():
     parser.add_argument('--size', action='store', type=int, default=LED_SIZE,
                         help='Size of the LEDs in pixels')
     parser.add_argument('-n', '--dry_run', action='store_true', help='No fadecandy connection')
+    parser.add_argument('--outputs', action='store', default=None,
+                        help='Device map JSON for sending to several OPC servers')
+    parser.add_argument('--udp', action='store_true',
+                        help='Send frames over UDP to an opc_udp bridge')
+    parser.add_argument('--upsample', action='store', type=int, default=0,
+                        help='Blend the LEDs between animation frames at this many fps (needs numpy)')
+    parser.add_argument('--show', action='store', default=None,
+                        help='Show file of timed light and sound cues to run')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Run the animation and LED output in their own processes')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='Run the asyncio main loop with the network control API')
+    parser.add_argument('--reload', action='store_true',
+                        help='Reload the sound config (and sounds) when the files change')
+    parser.add_argument('--control_port', action='store', type=int, default=None,
+                        help='Control API port number (--asyncio only, default 7891)')
+    parser.add_argument('--governor', action='store_true',
+                        help='Turn the preview off and the frame rate down when the Pi is struggling')
+    parser.add_argument('--sysfs_root', action='store', default='/',
+                        help='Where the governor looks for proc and sys (for testing with fake files)')
     args = parser.parse_args()
+    if args.pipeline and args.show:
+        parser.error("--show can't be used with --pipeline")
+    if args.pipeline and (args.outputs or args.udp):
+        parser.error("--outputs and --udp can't be used with --pipeline")
+    if args.outputs and args.udp:
+        parser.error("--outputs can't be used with --udp")
+    if args.asyncio and (args.pipeline or args.show):
+        parser.error("--asyncio can't be used with --pipeline or --show")
+    if args.upsample and (args.asyncio or args.pipeline):
+        parser.error("--upsample can't be used with --asyncio or --pipeline")
+    if args.governor and args.pipeline:
+        parser.error("--governor can't be used with --pipeline")
+    assert 0 <= args.upsample <= 1000
     assert 1024 <= args.port <= 65535
     assert 1 <= args.size
 
@@ -456,91 +620,227 @@ def parse_args():
 
     return args
 
-def main(args) -> None:
-    client = opc.Client(f'{args.host}:{args.port}') if not args.dry_run else None
-
-    pygame.init()
-    pygame.mixer.init()
+# Only the display.  The rest of pygame is started with pygame.init() once
+# the sound board has the mixer going.
+def init_display() -> pygame.Surface:
+    pygame.display.init()
     width = (RAIL_SIZE - STERN_SIZE) * (LED_SIZE + LED_GAP)
     height = NOSE_SIZE * (LED_SIZE + LED_GAP) * 2
     screen = pygame.display.set_mode((width, height), 0, 32)
     pygame.display.set_caption("Boat Light Sim")
-    print("Loading SFX...", flush=True)
-    sounds = sound_board.load_json(args.sound_json)
-    sounds.start()
-        
-    boat = Boat()
-    rate = int(1.0 / RATES[boat.mode] * 1000)  # frame rate in ms
+    return screen
+
+def load_config(sound_json: str) -> sound_board.BoardConfig:
+    config = sound_board.load_config(sound_json)
+    check_light_modes(config)
+    return config
 
-    running = True
-    while running:
-        # Great big giant IF/THEN/ELSE for the event queue.  Not ideal.
+def load_sounds(config: sound_board.BoardConfig, trace: startup.StartupTrace = None) -> sound_board.SoundBoard:
+    trace = trace or startup.StartupTrace()
+    print("Loading SFX...", flush=True)
+    if not pygame.mixer.get_init():
+        with trace.phase('mixer init'):
+            sound_board.init_mixer(dict(config.mixer))
+    with trace.phase('decode'):
+        sounds = sound_board.board_from_config(config)
+    sounds.index_modes(MODES)
+
+    # Sounds with a light cue in the config flash the lights etc. when they
+    # start.  They get to the boat through the event bus.
+    sounds.bus = events.EventBus()
+    return sounds
+
+def check_light_modes(config: sound_board.BoardConfig) -> None:
+    for snd in config.ambients + config.effects:
+        if snd.light and snd.light.mode and snd.light.mode not in MODES:
+            raise sound_board.SoundError(f"Unknown light mode {snd.light.mode!r} for {snd.filename!r}")
+
+def configure(boat: Boat, config: sound_board.BoardConfig, pipeline=None) -> None:
+    boat.configure(dict(config.animation))
+    if pipeline:
+        pipeline.configure(dict(config.animation))
+
+# Picks up a config the reloader has ready (if there is one).  Everything
+# slow was done on the reloader's thread so this is safe to call every frame.
+def reload_sounds(reloader: sound_board.Reloader, boat: Boat, sounds: sound_board.SoundBoard,
+                  pipeline=None) -> None:
+    ready = reloader.poll() if reloader else None
+    if ready is None:
+        return
+    config = ready[0]
+    try:
+        check_light_modes(config)
+        diff = sounds.reload(*ready)
+    except sound_board.SoundError as e:
+        print(f"Not reloading: {e}")
+        return
+    if diff['animation']:
+        configure(boat, config, pipeline)
+    print(f"Reloaded {reloader.config_filename!r}: "
+          f"{len(diff['effects_added'])} effects and {len(diff['ambients_added'])} ambients loaded, "
+          f"{len(diff['effects_removed'])} effects and {len(diff['ambients_removed'])} ambients dropped"
+          + (f", player {diff['player']}" if diff['player'] else '')
+          + (", new animation settings" if diff['animation'] else ''), flush=True)
+
+def set_mode(boat: Boat, sounds: sound_board.SoundBoard, new_mode: str, pipeline=None) -> None:
+    if new_mode == boat.mode:
+        return
+    print(f"Setting mode: {new_mode!r}")
+    music = sounds.mode_ambient(new_mode)
+    if music:
+        sounds.switch_ambient(music)
+    boat.mode = new_mode
+    if pipeline:
+        pipeline.set_mode(new_mode)
+
+def set_brightness(boat: Boat, value: float, ms: int = BRIGHT_RAMP) -> None:
+    old = boat.levels.target('brightness')
+    new = max(0.1, min(1.0, value))
+    boat.levels.ramp('brightness', new, ms)
+    if new > old:
+        print(f"Brightness increased to {new:0.02f}")
+    elif new < old:
+        print(f"Brightness decreased to {new:0.02f}")
+
+# Great big giant IF/THEN/ELSE for the event queue.  Not ideal.  Returns
+# False when it's time to quit.
+def handle_event(event, boat: Boat, sounds: sound_board.SoundBoard, pipeline=None,
+                 pressed: float = None) -> bool:
+    if event.type == pygame.QUIT:
+        return False
+    elif event.type == pygame.KEYDOWN:
+        # Handle the key presses.
+        if event.key == pygame.K_ESCAPE:
+            return False
+
+        # Handle the change in animation routines.
+        elif event.key in MODES_KEYS:
+            set_mode(boat, sounds, MODES_KEYS[event.key], pipeline)
+
+        # The default is to run the lights at full brightness.  This can
+        # be a bit much is some situations.  Use the +/- on the numeric
+        # keypad to change the brightness.
+        elif event.key == pygame.K_KP_PLUS:
+            set_brightness(boat, boat.levels.target('brightness') + BRIGHT_STEP)
+        elif event.key == pygame.K_KP_MINUS:
+            set_brightness(boat, boat.levels.target('brightness') - BRIGHT_STEP)
+
+        # Sounds can be played by pressing keys.  The keyboard is hidden
+        # in the starboard poopdeck area.  Be subtle and it looks/sounds
+        # amazing.
+        else:
+            action = sounds.key_press(event.unicode, pressed)
+            if not action:
+                # print(f"Unknown key {event.unicode!r}, {event.key=}")
+                pass
+
+    # For debugging, you can click on an individual LED and have it
+    # toggle.  This is great for debugging and finding out which LEDs
+    # are bad.
+    elif event.type == pygame.MOUSEBUTTONDOWN:
+        if event.button == 1:
+            boat.brush = boat.click(event.pos)
+    # Dragging paints every LED it goes over the same colour as the first
+    elif event.type == pygame.MOUSEMOTION:
+        if boat.brush is not None and event.buttons[0]:
+            boat.paint((event.pos[0] - event.rel[0], event.pos[1] - event.rel[1]), event.pos, boat.brush)
+    elif event.type == pygame.MOUSEBUTTONUP:
+        if event.button == 1:
+            boat.brush = None
+
+    # The ambient finished or the next one in its playlist took over
+    elif event.type == sound_board.MUSIC_END:
+        sounds.update()
+    return True
+
+class Input:
+    """Gets events to a handler as soon as they come in.
+
+    wait() sleeps like pygame.time.wait() but wakes up for every event, so a
+    key press plays its sound straight away instead of after the frame (up
+    to a second in the slow mode).
+
+    pygame doesn't timestamp events so the handler is also told when the
+    event came in: now if it woke us up, or the last time we looked at the
+    queue if it was already waiting.  That makes the latency numbers a
+    worst case.
+    """
+    def __init__(self, handler):
+        self.handler = handler      # handler(event, pressed) -> False to quit
+        self.running = True
+        self.last_poll = time.perf_counter()
+
+    def _handle(self, event, pressed: float) -> None:
+        self.running = self.handler(event, pressed) and self.running
+
+    def poll(self) -> None:
+        now = time.perf_counter()
         for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-            elif event.type == pygame.KEYDOWN:
-                # Handle the key presses.
-                if event.key == pygame.K_ESCAPE:
-                    running = False
-
-                # Handle the change in animation routines.
-                elif event.key in MODES_KEYS:
-                    new_mode = MODES_KEYS[event.key]
-                    if new_mode != boat.mode:
-                        print(f"Setting mode: {MODES_KEYS[event.key]!r}")
-                        for music in sounds.ambients:
-                            fn = os.path.split(music.filename)[-1]
-                            if fn.startswith(new_mode):
-                                sounds.play_ambient(music)
-                                break
-                        boat.mode = new_mode
-                        rate = int(1.0 / RATES[boat.mode] * 1000)  # frame rate in ms
-
-                # The default is to run the lights at full brightness.  This can
-                # be a bit much is some situations.  Use the +/- on the numeric
-                # keypad to change the brightness.
-                elif event.key == pygame.K_KP_PLUS:
-                    boat.brightness = min(1.0, boat.brightness + BRIGHT_STEP)
-                    print(f"Brightness increased to {boat.brightness:0.02f}")
-                elif event.key == pygame.K_KP_MINUS:
-                    boat.brightness = max(0.1, boat.brightness - BRIGHT_STEP)
-                    print(f"Brightness decreased to {boat.brightness:0.02f}")
-
-                # Sounds can be played by pressing keys.  The keyboard is hidden
-                # in the starboard poopdeck area.  Be subtle and it looks/sounds
-                # amazing.
-                else:
-                    action = sounds.key_press(event.unicode)
-                    if not action:
-                        # print(f"Unknown key {event.unicode!r}, {event.key=}")
-                        pass
-            
-            # For debugging, you can click on an individual LED and have it
-            # toggle.  This is great for debugging and finding out which LEDs
-            # are bad.
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                if event.button == 1:
-                    boat.click(event.pos)
-
-        # Update the display.
-        dt = pygame.time.wait(rate)
-        boat.update(dt)
-        boat.draw(screen)
+            self._handle(event, self.last_poll)
+        self.last_poll = now
+
+    def wait(self, ms: int) -> int:
+        start = pygame.time.get_ticks()
+        end = start + ms
+        while self.running:
+            left = end - pygame.time.get_ticks()
+            if left <= 0:
+                break
+            before = time.perf_counter()
+            event = pygame.event.wait(left)
+            now = time.perf_counter()
+            if event.type != pygame.NOEVENT:
+                self._handle(event, now if now - before > 0.001 else self.last_poll)
+            self.last_poll = now
+        return pygame.time.get_ticks() - start
+
+def start_governor(args):
+    """The quality governor and its resource monitor, if asked for."""
+    if not args.governor:
+        return None
+    import governor as quality_governor
+    monitor = quality_governor.ResourceMonitor(args.sysfs_root)
+    monitor.start()
+    return quality_governor.Governor(monitor)
+
+def govern(governor, screen: pygame.Surface) -> tuple:
+    """Let the governor have its say.  Returns (rate scale, preview on)."""
+    if governor is None:
+        return 1, True
+    changed = governor.poll()
+    if changed and not changed.preview:
+        screen.fill((0, 0, 0))
         pygame.display.flip()
-
-        # Update the LEDs.
-        if client:
-            strands = boat.strands
-            client.put_pixels(sum(strands, []))
-            if not TEMPORAL_DITHERING:
-                client.put_pixels(sum(strands, []))
+    return governor.quality.rate_scale, governor.quality.preview
+
+def stop_governor(governor) -> None:
+    if governor:
+        governor.monitor.stop()
+        print(f"Governor: {governor.report()}")
+
+def connect(args):
+    """The OPC client, or the output router if there's a device map."""
+    if args.dry_run:
+        return None
+    if args.outputs:
+        return output.load_json(args.outputs)
+    if args.udp:
+        return opc_udp.DatagramClient(f'{args.host}:{args.port}')
+    return opc.Client(f'{args.host}:{args.port}')
+
+def fade_out(client: opc.Client, strands: list) -> None:
+    # The router doesn't block so give it a chance to get each frame out.
+    def send(pixels):
+        client.put_pixels(pixels)
+        if isinstance(client, output.OutputRouter):
+            client.flush()
 
     # When quitting, fade out the LEDs and the sounds.
     quit_fade = [(0, 0, 0)] * 512
     if client:
-        client.put_pixels(sum(strands, []))
+        send(sum(strands, []))
         time.sleep(FADE_TIME / 1000.0)
-        client.put_pixels(quit_fade)
+        send(quit_fade)
 
     pygame.mixer.music.fadeout(FADE_TIME)  # Stop the background sounds
     pygame.mixer.fadeout(FADE_TIME)        # Stop any sound effects
@@ -548,11 +848,309 @@ def main(args) -> None:
 
     # Turn off all of the LEDs when exiting
     if client:
-        client.put_pixels(quit_fade)
-        client.put_pixels(quit_fade)
+        send(quit_fade)
+        send(quit_fade)
+
+    if isinstance(client, output.OutputRouter):
+        for name, stats in client.report().items():
+            print(f"Output {name!r}: {stats}")
+
+def main(args) -> None:
+    trace = startup.StartupTrace()
+    trace.add('imports', startup.STARTED, IMPORTED)
+
+    # First light: get the default mode on the LEDs before anything slow.
+    # The compiled config is usually cached so reading it is quick.
+    with trace.phase('config'):
+        config = load_config(args.sound_json)
+
+    def configured_boat() -> Boat:
+        boat = Boat()
+        boat.configure(dict(config.animation))
+        return boat
+
+    boat = configured_boat()
+    client = None
+    pipeline = None
+    with trace.phase('first frame'):
+        # The pipeline runs the animation and the OPC output in worker
+        # processes.  The boat here is then just the preview.
+        if args.pipeline:
+            import pipeline as mp_pipeline
+            host = None if args.dry_run else args.host
+            pipeline = mp_pipeline.Pipeline(len(boat.pixels), host, args.port)
+            pipeline.start()
+            pipeline.configure(dict(config.animation))
+        else:
+            client = connect(args)
+            boat.update(0)
+            strands = boat.strands
+            if client:
+                client.put_pixels(sum(strands, []))
+    first_light = trace.mark('first light')
+    if first_light > FIRST_LIGHT_BUDGET:
+        print(f"First light took {first_light:.0f} ms (budget {FIRST_LIGHT_BUDGET} ms)", flush=True)
+
+    # The sounds load in the background while the display comes up, and
+    # the lights keep going until they're ready.  The mixer starts here
+    # first: SDL can't start its audio and video on two threads at once, and
+    # the mixer's settings only count if it beats pygame.init().  Only the
+    # decoding happens on the thread.
+    with trace.phase('mixer init'):
+        sound_board.init_mixer(dict(config.mixer))
+    loader = startup.Background(load_sounds, config, trace, name='sound-loader')
+    with trace.phase('display'):
+        screen = init_display()
+    with trace.phase('waiting on sfx'):
+        last = next_frame = time.perf_counter()
+        while not loader.done:
+            pygame.event.pump()
+            now = time.perf_counter()
+            if now >= next_frame:
+                if not pipeline:
+                    boat.update(int((now - last) * 1000))
+                    if client:
+                        client.put_pixels(sum(boat.strands, []))
+                boat.draw(screen)
+                pygame.display.flip()
+                last = now
+                next_frame = now + 1.0 / RATES[boat.mode]
+            time.sleep(0.005)
+        sounds = loader.result()
+        pygame.init()
+    bus = sounds.bus
+    sounds.start()
+
+    sequencer = None
+    if args.show:
+        import show as show_file
+        print("Loading show...", flush=True)
+        with trace.phase('show'):
+            show = show_file.load_json(args.show, MODES)
+            caches = [show_file.prerender(seg, configured_boat, RATES) for seg in show.segments]
+            sequencer = show_file.Sequencer(show, sounds, caches, int(sounds.output_latency))
+
+    reloader = None
+    if args.reload:
+        reloader = sound_board.Reloader(sounds, args.sound_json)
+        reloader.start()
+
+    # Smooth out the slow modes by blending between frames on the way out.
+    # The animation itself only runs at the mode's rate.
+    upsampler = None
+    if args.upsample:
+        import upsample     # Needs numpy so only if asked for
+        upsampler = upsample.Upsampler(args.upsample)
+
+    # Backs off the preview and the frame rate if the Pi gets hot or busy
+    governor = start_governor(args)
+
+    if pipeline:
+        bus.subscribe('light_cue', pipeline.cue)
+    else:
+        bus.subscribe('light_cue', boat.cue)
+    trace.mark('ready')
+    print(trace.report(), flush=True)
+
+    inputs = Input(lambda event, pressed: handle_event(event, boat, sounds, pipeline, pressed))
+
+    strands = [OFF] * 8
+    since_key = 0
+    while inputs.running:
+        started = time.perf_counter()
+        inputs.poll()
+
+        # Start any ambient that was waiting for the old one to fade out.
+        sounds.update()
+        reload_sounds(reloader, boat, sounds, pipeline)
+        scale, preview = govern(governor, screen)
+
+        # Update the display.  The show can change the mode so the frame
+        # rate is worked out every time around.
+        rate = int(1.0 / RATES[boat.mode] * 1000) * scale  # frame rate in ms
+        keyframe = True
+        if pipeline:
+            dt = inputs.wait(min(rate, PIPELINE_UI_WAIT))
+            pixels = pipeline.latest()
+            if pixels:
+                boat.pixels = pixels
+            boat.tick_levels()
+        else:
+            # With the upsampler the loop runs at the output rate and the
+            # animation only moves on when it's due a new frame.
+            wait = upsampler.period if upsampler else rate
+            before = time.perf_counter()
+            dt = sequencer.wait(wait, inputs.wait) if sequencer else inputs.wait(wait)
+            waited = time.perf_counter() - before
+            since_key += dt
+            keyframe = since_key >= rate or not upsampler
+            if keyframe:
+                if not (sequencer and sequencer.update(boat)):
+                    boat.update(since_key)
+                since_key = 0
+        if keyframe and preview:
+            boat.draw(screen)
+            pygame.display.flip()
+
+        # Update the LEDs.
+        if client and upsampler:
+            now = pygame.time.get_ticks()
+            if keyframe:
+                strands = boat.strands
+                upsampler.add_keyframe(sum(strands, []), now)
+            client.put_pixels(upsampler.frame(now))
+        elif client:
+            strands = boat.strands
+            client.put_pixels(sum(strands, []))
+            if not TEMPORAL_DITHERING:
+                client.put_pixels(sum(strands, []))
+
+        # Late means the work (not the waiting) didn't fit in the time
+        # there was for it.
+        if governor and not pipeline:
+            governor.frame((time.perf_counter() - started - waited) * 1000, wait)
+
+    if reloader:
+        reloader.stop()
+    stop_governor(governor)
+
+    # The pipeline's output process fades the LEDs itself.
+    if pipeline:
+        pipeline.stop()
+    fade_out(client, strands)
+    if pipeline:
+        pipeline.join()
 
     pygame.quit()
 
-if __name__ == '__main__':
-    main(parse_args())
+    for topic, report in bus.report().items():
+        print(f"Dispatch latency {topic!r}: {report}")
+    if upsampler:
+        print(f"Upsampler: {upsampler.report()}")
+    if sounds.pool:
+        print(f"Voice pool: {sounds.pool.report()}")
+    print(f"Keypress to sound: {sounds.latency_report()}")
+
+# The same boat but run as a bunch of asyncio tasks so a network control
+# API can share the loop with the animation.  Rendering never waits on a
+# client: the API only leaves commands for the next frame.
+async def main_async(args) -> None:
+    import asyncio
+    import control
+
+    client = connect(args)
+
+    sounds = load_sounds(load_config(args.sound_json))
+    screen = init_display()
+    pygame.init()
+    bus = sounds.bus
+    sounds.start()
+
+    boat = Boat()
+    boat.configure(dict(sounds.config.animation))
+    bus.subscribe('light_cue', boat.cue)
+
+    reloader = None
+    if args.reload:
+        reloader = sound_board.Reloader(sounds, args.sound_json)
+        reloader.start()
+    governor = start_governor(args)
+
+    loop = asyncio.get_running_loop()
+    quit = asyncio.Event()
+    frame_ready = asyncio.Event()
+    commands = control.Commands()
+    frames = 0
+
+    def status() -> dict:
+        ambient = sounds.current_ambient.filename if sounds.current_ambient else None
+        return dict(mode=boat.mode, brightness=round(boat.brightness, 2), ambient=ambient,
+                    frames=frames, clients=server.clients, paused=sounds.paused)
+
+    server = control.ControlServer(commands, status, MODES)
+    await server.start(port=args.control_port or control.CONTROL_PORT)
+
+    inputs = Input(lambda event, pressed: handle_event(event, boat, sounds, None, pressed))
+
+    async def input_task():
+        while True:
+            inputs.poll()
+            if not inputs.running:
+                quit.set()
+            await asyncio.sleep(INPUT_POLL / 1000)
+
+    async def sound_task():
+        while True:
+            key = await commands.sounds.get()
+            sounds.key_press(key)
+
+    async def frame_task():
+        nonlocal frames
+        last = loop.time()
+        while True:
+            mode, brightness, delta = commands.take()
+            if mode is not None:
+                set_mode(boat, sounds, mode)
+            if brightness is not None or delta:
+                level = boat.levels.target('brightness') if brightness is None else brightness
+                set_brightness(boat, level + delta)
+
+            sounds.update()
+            reload_sounds(reloader, boat, sounds)
+            scale, preview = govern(governor, screen)
+            now = loop.time()
+            boat.update(int((now - last) * 1000))
+            last = now
+            if preview:
+                boat.draw(screen)
+                pygame.display.flip()
+            frames += 1
+            frame_ready.set()
+
+            rate = scale / RATES[boat.mode]
+            if governor:
+                governor.frame((loop.time() - now) * 1000, 1000 * rate)
+            await asyncio.sleep(max(0.0, rate - (loop.time() - now)))
+
+    # The OPC client uses a blocking socket so the send happens on a thread.
+    # If the server is slow we just skip to the newest frame.
+    async def output_task():
+        while True:
+            await frame_ready.wait()
+            frame_ready.clear()
+            pixels = sum(boat.strands, [])
+            await loop.run_in_executor(None, client.put_pixels, pixels)
+            if not TEMPORAL_DITHERING:
+                await loop.run_in_executor(None, client.put_pixels, pixels)
+
+    tasks = [asyncio.create_task(input_task()),
+             asyncio.create_task(sound_task()),
+             asyncio.create_task(frame_task())]
+    if client:
+        tasks.append(asyncio.create_task(output_task()))
+
+    await quit.wait()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await server.close()
+    if reloader:
+        reloader.stop()
+    stop_governor(governor)
+
+    await loop.run_in_executor(None, fade_out, client, boat.strands)
+    pygame.quit()
+
+    for topic, report in bus.report().items():
+        print(f"Dispatch latency {topic!r}: {report}")
+    if sounds.pool:
+        print(f"Voice pool: {sounds.pool.report()}")
+    print(f"Keypress to sound: {sounds.latency_report()}")
 
+if __name__ == '__main__':
+    args = parse_args()
+    if args.asyncio:
+        import asyncio
+        asyncio.run(main_async(args))
+    else:
+        main(args)
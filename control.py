@@ -0,0 +1,203 @@
+import json
+import asyncio
+import argparse
+
+# Probably overkill
+import logging
+logger = logging.getLogger("[Control]")
+
+CONTROL_HOST = '0.0.0.0'
+CONTROL_PORT = 7891
+
+# Keep a misbehaving client from eating all of the memory or holding up
+# its own replies forever.
+MAX_LINE = 4096
+WRITE_TIMEOUT = 1.0
+
+COMMANDS = ('mode', 'brightness', 'key', 'status')
+
+class ControlError(Exception): pass
+
+class Commands:
+    """Commands from the control API waiting for the next frame.
+
+    Mode and brightness are coalesced: if ten phones change the mode in the
+    same frame only the last one counts.  Sound triggers aren't, they go on
+    a queue that the sound task empties straight away.
+    """
+    def __init__(self):
+        self.mode = None
+        self.brightness = None
+        self.brightness_delta = 0.0
+        self.sounds = asyncio.Queue()
+
+    def set_mode(self, mode: str) -> None:
+        self.mode = mode
+
+    def set_brightness(self, value: float = None, delta: float = None) -> None:
+        if value is not None:
+            self.brightness = value
+            self.brightness_delta = 0.0
+        if delta is not None:
+            self.brightness_delta += delta
+
+    def take(self) -> tuple:
+        """Return (mode, brightness, brightness_delta) and clear them."""
+        pending = (self.mode, self.brightness, self.brightness_delta)
+        self.mode = None
+        self.brightness = None
+        self.brightness_delta = 0.0
+        return pending
+
+class ControlServer:
+    """A newline delimited JSON control API.
+
+    Every request is a JSON object on one line with a 'cmd' and gets one
+    JSON object back:
+
+        {"cmd": "mode", "mode": "disco"}
+        {"cmd": "brightness", "value": 0.5}  or  {"cmd": "brightness", "delta": -0.1}
+        {"cmd": "key", "key": "q"}
+        {"cmd": "status"}
+
+    Nothing here touches the boat or the sound board.  Commands are handed
+    to a Commands object and status comes from a callable so the render
+    loop never waits on a client.
+    """
+    def __init__(self, commands: Commands, status, modes: set = None):
+        self.commands = commands
+        self.status = status
+        self.modes = modes
+        self.clients = 0
+        self.requests = 0
+        self._server = None
+
+    async def start(self, host: str = CONTROL_HOST, port: int = CONTROL_PORT) -> None:
+        self._server = await asyncio.start_server(self._client, host, port, limit=MAX_LINE)
+        logger.info(f"Control API listening on {host}:{port}")
+
+    async def close(self) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    @property
+    def port(self) -> int:
+        return self._server.sockets[0].getsockname()[1]
+
+    def handle(self, request: dict) -> dict:
+        cmd = request.get('cmd')
+        if cmd not in COMMANDS:
+            raise ControlError(f"Unknown command {cmd!r}")
+
+        if cmd == 'mode':
+            mode = request.get('mode')
+            if self.modes is not None and mode not in self.modes:
+                raise ControlError(f"Unknown mode {mode!r}")
+            self.commands.set_mode(mode)
+        elif cmd == 'brightness':
+            value = request.get('value')
+            delta = request.get('delta')
+            if value is None and delta is None:
+                raise ControlError("Brightness needs a value or a delta")
+            if value is not None and not (0.0 <= float(value) <= 1.0):
+                raise ControlError(f"Invalid brightness ({value})")
+            self.commands.set_brightness(None if value is None else float(value),
+                                         None if delta is None else float(delta))
+        elif cmd == 'key':
+            key = request.get('key')
+            if not isinstance(key, str) or not key:
+                raise ControlError("Key needs a key")
+            self.commands.sounds.put_nowait(key)
+        elif cmd == 'status':
+            return dict(ok=True, **self.status())
+        return dict(ok=True)
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info('peername')
+        self.clients += 1
+        logger.info(f"Client connected: {peer}")
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (asyncio.LimitOverrunError, ValueError):
+                    logger.warning(f"Line too long from {peer}")
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+
+                self.requests += 1
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ControlError("Requests must be JSON objects")
+                    reply = self.handle(request)
+                except (ValueError, TypeError, ControlError) as e:
+                    reply = dict(ok=False, error=str(e))
+
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.clients -= 1
+            logger.info(f"Client disconnected: {peer}")
+            writer.close()
+
+# A little client for poking at the API without a phone.  Also handy for
+# seeing how the boat copes with a crowd: --clients opens lots of
+# connections and has each of them send the same command.
+async def send(host: str, port: int, requests: list) -> list:
+    reader, writer = await asyncio.open_connection(host, port)
+    replies = []
+    try:
+        for request in requests:
+            writer.write(json.dumps(request).encode() + b'\n')
+            await writer.drain()
+            replies.append(json.loads(await reader.readline()))
+    finally:
+        writer.close()
+    return replies
+
+def parse_request(words: list) -> dict:
+    cmd = words[0]
+    if cmd == 'mode':
+        return dict(cmd='mode', mode=words[1])
+    elif cmd == 'brightness':
+        value = words[1]
+        if value[0] in '+-':
+            return dict(cmd='brightness', delta=float(value))
+        return dict(cmd='brightness', value=float(value))
+    elif cmd == 'key':
+        return dict(cmd='key', key=words[1])
+    return dict(cmd=cmd)
+
+async def test_client(args) -> None:
+    request = parse_request(args.command)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    replies = await asyncio.gather(*[send(args.host, args.port, [request] * args.repeat)
+                                     for _ in range(args.clients)])
+    elapsed = loop.time() - start
+
+    print(json.dumps(replies[0][-1], indent=2))
+    n = args.clients * args.repeat
+    failed = sum(1 for r in sum(replies, []) if not r.get('ok'))
+    print(f"{n} requests from {args.clients} clients in {elapsed * 1000:.1f} ms ({failed} failed)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pirate LED Controller test client')
+    parser.add_argument('command', nargs='+',
+                        help="status | mode <mode> | brightness <0-1 or +/-delta> | key <key>")
+    parser.add_argument('--host', action='store', default='localhost', help='Boat hostname')
+    parser.add_argument('--port', action='store', type=int, default=CONTROL_PORT,
+                        help='Control API port number')
+    parser.add_argument('--clients', action='store', type=int, default=1,
+                        help='Number of clients to connect at once')
+    parser.add_argument('--repeat', action='store', type=int, default=1,
+                        help='Number of times each client sends the command')
+    asyncio.run(test_client(parser.parse_args()))
@@ -0,0 +1,293 @@
+import sys
+import time
+import argparse
+
+from collections import defaultdict
+
+import pygame
+
+# Probably overkill
+import logging
+logger = logging.getLogger("[Diagnostic]")
+
+# Names of Boat.strips, in order
+STRIP_NAMES = ('wave_left', 'wave_right', 'rail_left', 'rail_right', 'kitt')
+
+# The Fade Candy drives 8 strands of 64 and the boat sends all of them
+STRAND_SIZE = 64
+FRAME_PIXELS = 512
+
+# Walk test defaults
+WALK_RATE = 4.0         # Steps a second
+WALK_COLOR = (255, 255, 255)
+
+class DiagnosticError(Exception): pass
+
+class HitIndex:
+    """Finds the LED under a point without looking at every LED.
+
+    The window is cut into cells about the size of an LED and each cell
+    remembers the LEDs that overlap it, so a lookup is one dict get and a
+    couple of rect checks however many LEDs there are.
+    """
+    def __init__(self, strips: tuple, cell: int):
+        if cell < 1:
+            raise DiagnosticError(f"Invalid cell size ({cell})")
+        self.cell = cell
+        self._cells = defaultdict(list)     # (column, row) -> [(strip, index, led)]
+        for strip_ix, strip in enumerate(strips):
+            for led_ix, led in enumerate(strip):
+                r = led.rect
+                for cx in range(r.left // cell, (r.right - 1) // cell + 1):
+                    for cy in range(r.top // cell, (r.bottom - 1) // cell + 1):
+                        self._cells[(cx, cy)].append((strip_ix, led_ix, led))
+
+    def hit(self, pos: tuple) -> tuple:
+        """(strip, index) of the LED at pos, or None."""
+        for strip_ix, led_ix, led in self._cells.get((pos[0] // self.cell, pos[1] // self.cell), ()):
+            if led.rect.collidepoint(pos):
+                return strip_ix, led_ix
+        return None
+
+    def line(self, start: tuple, end: tuple) -> list:
+        """Every LED along a line, in order.  A quick drag can skip right
+        over LEDs between two mouse events so paint the whole way."""
+        steps = max(1, int(max(abs(end[0] - start[0]), abs(end[1] - start[1])) * 2 // self.cell))
+        hits = []
+        for step in range(steps + 1):
+            pos = (start[0] + (end[0] - start[0]) * step // steps,
+                   start[1] + (end[1] - start[1]) * step // steps)
+            hit = self.hit(pos)
+            if hit is not None and (not hits or hits[-1] != hit):
+                hits.append(hit)
+        return hits
+
+def channel_map(boat) -> dict:
+    """Where each LED ends up in the frame sent to the OPC server.
+
+    Rather than repeating the wiring in Boat.strands, every LED is given a
+    colour that encodes its position, the strands are built, and whatever
+    comes out at each pixel says which LED it was.  Returns a dict of frame
+    pixel -> (strip, index).
+    """
+    saved = boat.pixels
+    leds = [(strip_ix, led_ix) for strip_ix, strip in enumerate(boat.strips)
+            for led_ix in range(len(strip))]
+    try:
+        boat.pixels = [((n >> 16) & 255, (n >> 8) & 255, n & 255) for n in range(1, len(leds) + 1)]
+        frame = [c for strand in boat.strands for c in strand]
+    finally:
+        boat.pixels = saved
+
+    mapping = {}
+    for pixel, (r, g, b) in enumerate(frame):
+        n = (r << 16) | (g << 8) | b
+        if n:
+            mapping[pixel] = leds[n - 1]
+    return mapping
+
+def describe(pixel: int, mapping: dict, router=None) -> str:
+    """Where a frame pixel is: strand and offset, any output endpoints and
+    the LED on the boat it drives."""
+    where = f"pixel {pixel:3d} (strand {pixel // STRAND_SIZE} offset {pixel % STRAND_SIZE:2d})"
+    if router is not None:
+        devices = ', '.join(f"{name}[{device}]" for name, device in router.locate(pixel))
+        where += f" -> {devices or 'no endpoint'}"
+    if pixel in mapping:
+        strip_ix, led_ix = mapping[pixel]
+        return f"{where}: {STRIP_NAMES[strip_ix]}[{led_ix}]"
+    return f"{where}: not on the boat"
+
+class WalkTest:
+    """Lights one pixel (or strand) of the frame at a time.
+
+    Stepping through the frame at a steady rate while someone watches the
+    boat shows which physical LED each frame pixel lights, including the
+    ones on strands the Boat doesn't know about yet (wings, tail).
+    """
+    def __init__(self, pixels: int = FRAME_PIXELS, rate: float = WALK_RATE,
+                 start: int = 0, by_strand: bool = False, color: tuple = WALK_COLOR):
+        if rate <= 0:
+            raise DiagnosticError(f"Invalid walk rate ({rate})")
+        if not (0 <= start < pixels):
+            raise DiagnosticError(f"Start pixel {start} isn't in the frame (0 - {pixels - 1})")
+        self.pixels = pixels
+        self.rate = rate
+        self.step_size = STRAND_SIZE if by_strand else 1
+        self.position = start - start % self.step_size
+        self.color = color
+        self.running = False
+        self._next = 0.0
+
+    @property
+    def lit(self) -> range:
+        return range(self.position, min(self.pixels, self.position + self.step_size))
+
+    def step(self, direction: int = 1) -> None:
+        self.position = (self.position + direction * self.step_size) % self.pixels
+
+    def toggle(self, now: float) -> None:
+        self.running = not self.running
+        self._next = now + 1.0 / self.rate
+
+    def advance(self, now: float) -> bool:
+        """Move on if it's time.  Returns True if it moved."""
+        if not self.running or now < self._next:
+            return False
+        self.step()
+        self._next = max(self._next + 1.0 / self.rate, now)
+        return True
+
+    def frame(self) -> list:
+        frame = [(0, 0, 0)] * self.pixels
+        for pixel in self.lit:
+            frame[pixel] = self.color
+        return frame
+
+def parse_args():
+    import boat as ship
+    parser = argparse.ArgumentParser(description='Find dead and miswired LEDs')
+    parser.add_argument('--host', action='store', default=ship.FADECANDY_HOST,
+                        help='Fadecandy client hostname')
+    parser.add_argument('--port', action='store', type=int, default=ship.FADECANDY_PORT,
+                        help='Fadecandy client port number')
+    parser.add_argument('-n', '--dry_run', action='store_true', help='No fadecandy connection')
+    parser.add_argument('--outputs', action='store', default=None,
+                        help='Device map JSON for sending to several OPC servers')
+    parser.add_argument('--udp', action='store_true',
+                        help='Send frames over UDP to an opc_udp bridge')
+    parser.add_argument('--walk', action='store_true', help='Start the walk test straight away')
+    parser.add_argument('--rate', action='store', type=float, default=WALK_RATE,
+                        help='Walk test steps per second')
+    parser.add_argument('--start', action='store', type=int, default=0,
+                        help='Frame pixel to start the walk test from')
+    parser.add_argument('--pixels', action='store', type=int, default=FRAME_PIXELS,
+                        help='Size of the frame to walk through')
+    parser.add_argument('--strands', action='store_true',
+                        help='Walk a whole strand at a time')
+    parser.add_argument('--map', action='store_true',
+                        help='Print where every frame pixel goes and quit')
+    args = parser.parse_args()
+    if args.outputs and args.udp:
+        parser.error("--outputs can't be used with --udp")
+    return args
+
+HELP = """Left click/drag: paint white   Right click/drag: paint black   Click: show where an LED is wired
+w: start/stop the walk test   Left/Right: step   +/-: walk faster/slower
+x: note the lit pixel   c: all off   f: all on   Esc: quit"""
+
+def main(args) -> None:
+    import boat as ship
+
+    boat = ship.Boat()
+    boat.mode = 'debug'
+    mapping = channel_map(boat)
+    client = ship.connect(args)
+    router = client if isinstance(client, ship.output.OutputRouter) else None
+
+    if args.map:
+        for pixel in range(args.pixels):
+            print(describe(pixel, mapping, router))
+        return
+
+    walk = WalkTest(args.pixels, args.rate, args.start, args.strands)
+    hits = HitIndex(boat.strips, ship.LED_SIZE + ship.LED_GAP)
+    pixel_of = {led: pixel for pixel, led in mapping.items()}
+    notes = []
+
+    screen = ship.init_display()
+    pygame.display.set_caption("Boat LED Diagnostic")
+    print(HELP, flush=True)
+
+    def show_walk():
+        # Light the LEDs in the window that the lit pixels drive
+        boat.off()
+        for pixel in walk.lit:
+            if pixel in mapping:
+                strip_ix, led_ix = mapping[pixel]
+                boat.strips[strip_ix][led_ix].color = walk.color
+        print(f"Walk: {describe(walk.position, mapping, router)}"
+              + (f" (+{len(walk.lit) - 1})" if len(walk.lit) > 1 else ''), flush=True)
+
+    def paint(start, end, color):
+        for strip_ix, led_ix in hits.line(start, end):
+            boat.strips[strip_ix][led_ix].color = color
+
+    brush = None
+    last_pos = None
+    walking = args.walk     # The frame comes from the walk test, not the boat
+    if walking:
+        walk.toggle(time.monotonic())
+        show_walk()
+    running = True
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_ESCAPE:
+                    running = False
+                elif event.key == pygame.K_w:
+                    walk.toggle(time.monotonic())
+                    walking = True
+                    show_walk()
+                elif event.key in (pygame.K_RIGHT, pygame.K_LEFT):
+                    walk.step(1 if event.key == pygame.K_RIGHT else -1)
+                    walking = True
+                    show_walk()
+                elif event.key in (pygame.K_PLUS, pygame.K_EQUALS, pygame.K_KP_PLUS):
+                    walk.rate *= 2
+                    print(f"Walk rate: {walk.rate:g} steps/s")
+                elif event.key in (pygame.K_MINUS, pygame.K_KP_MINUS):
+                    walk.rate /= 2
+                    print(f"Walk rate: {walk.rate:g} steps/s")
+                elif event.key == pygame.K_x:
+                    notes.append(walk.position)
+                    print(f"Noted {describe(walk.position, mapping, router)}")
+                elif event.key == pygame.K_c:
+                    walk.running = walking = False
+                    boat.off()
+                elif event.key == pygame.K_f:
+                    walk.running = walking = False
+                    boat.bright()
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button in (1, 3):
+                walk.running = walking = False
+                hit = hits.hit(event.pos)
+                if hit is not None:
+                    strip_ix, led_ix = hit
+                    pixel = pixel_of.get(hit)
+                    where = describe(pixel, mapping, router) if pixel is not None else "not sent"
+                    print(f"{STRIP_NAMES[strip_ix]}[{led_ix}]: {where}")
+                brush = WALK_COLOR if event.button == 1 else (0, 0, 0)
+                last_pos = event.pos
+                paint(last_pos, last_pos, brush)
+            elif event.type == pygame.MOUSEMOTION and brush is not None:
+                paint(last_pos, event.pos, brush)
+                last_pos = event.pos
+            elif event.type == pygame.MOUSEBUTTONUP:
+                brush = None
+
+        if walk.advance(time.monotonic()):
+            show_walk()
+
+        screen.fill((0, 0, 0))
+        boat.draw(screen)
+        pygame.display.flip()
+        if client:
+            client.put_pixels(walk.frame() if walking else sum(boat.strands, []))
+        pygame.time.wait(10)
+
+    if client:
+        client.put_pixels([(0, 0, 0)] * args.pixels)
+        if router:
+            router.flush()
+    pygame.quit()
+    for pixel in notes:
+        print(f"Note: {describe(pixel, mapping, router)}")
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except DiagnosticError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
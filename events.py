@@ -0,0 +1,75 @@
+import time
+
+from collections import defaultdict, deque
+
+# Probably overkill
+import logging
+logger = logging.getLogger("[Events]")
+
+# Keeps running numbers on how long something takes.  Only the most recent
+# samples are kept for the percentiles so this can run all night.
+class LatencyStats:
+    def __init__(self, history: int = 1000):
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.samples = deque(maxlen=history)
+
+    def add(self, ms: float) -> None:
+        self.count += 1
+        self.total += ms
+        self.worst = max(self.worst, ms)
+        self.samples.append(ms)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, pct: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        ix = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+        return ordered[ix]
+
+    def report(self) -> str:
+        return (f"n={self.count} mean={self.mean:.2f} ms "
+                f"p95={self.percentile(95):.2f} ms max={self.worst:.2f} ms")
+
+# A tiny publish/subscribe bus.  Handlers are called straight away from
+# publish() so nothing has to poll for events every frame.
+class EventBus:
+    def __init__(self):
+        self._handlers = defaultdict(list)
+        self.latency = defaultdict(LatencyStats)
+
+    def subscribe(self, topic: str, handler) -> None:
+        self._handlers[topic].append(handler)
+
+    def unsubscribe(self, topic: str, handler) -> None:
+        if handler in self._handlers[topic]:
+            self._handlers[topic].remove(handler)
+
+    def publish(self, topic: str, payload=None, since: float = None) -> int:
+        """Call every handler for topic with payload.
+
+        since is the time.perf_counter() the event really started (e.g. the
+        key press).  The time from then until all of the handlers are done
+        is recorded in self.latency[topic].  Returns the number of handlers.
+        """
+        if since is None:
+            since = time.perf_counter()
+
+        handlers = self._handlers.get(topic, ())
+        for handler in handlers:
+            try:
+                handler(payload)
+            except Exception:
+                logger.exception(f"Handler {handler!r} failed for {topic!r}")
+
+        if handlers:
+            self.latency[topic].add((time.perf_counter() - since) * 1000)
+        return len(handlers)
+
+    def report(self) -> dict:
+        return {topic: stats.report() for topic, stats in self.latency.items()}
@@ -0,0 +1,284 @@
+import os
+import time
+import threading
+
+from dataclasses import dataclass
+from collections import deque, Counter
+
+# Probably overkill
+import logging
+logger = logging.getLogger("[Governor]")
+
+# Where things are on a Pi.  All of them are read relative to a root so a
+# fake tree of files can stand in for the real thing when testing.
+PROC_STAT = 'proc/stat'
+THERMAL_ZONE = 'sys/class/thermal/thermal_zone0/temp'
+GET_THROTTLED = 'sys/devices/platform/soc/soc:firmware/get_throttled'
+
+# get_throttled bits that mean it's happening right now.  The same bits
+# shifted up 16 mean it has happened since boot.
+THROTTLE_FLAGS = {0x1: 'under-voltage', 0x2: 'frequency capped', 0x4: 'throttled', 0x8: 'soft temp limit'}
+THROTTLED_NOW = 0xf
+
+# How often the monitor looks (seconds)
+SAMPLE_INTERVAL = 1.0
+
+# Over these and things are getting tight, under the low ones there's room
+# to spare.  The gap between them stops it flapping back and forth.  The
+# Pi starts soft throttling at 60-80 C depending on the model and config.
+CPU_HIGH = 0.85
+CPU_LOW = 0.50
+TEMP_HIGH = 75.0
+TEMP_LOW = 68.0
+
+# A frame is late if the work for it (not counting the wait for the next
+# one) took this much longer than the frame period.  The share of late
+# frames (over the last FRAME_WINDOW) counts as pressure too.
+OVERRUN_SLACK = 0.2
+OVERRUN_HIGH = 0.2
+OVERRUN_LOW = 0.05
+FRAME_WINDOW = 50
+
+# How long the pressure (or the headroom) has to last before anything
+# changes (seconds).  Quick to back off, slow to push it again.
+DEGRADE_AFTER = 2.0
+RESTORE_AFTER = 15.0
+
+class GovernorError(Exception): pass
+
+# One step on the way down.  rate_scale stretches every frame so a mode
+# runs at 1/rate_scale of its normal frame rate.  The modes move one step a
+# frame so they run at 1/rate_scale of their speed too: it looks different,
+# not just choppier.  The upsampler or the Fade Candy's own interpolation
+# smooths over the gaps.
+@dataclass(frozen=True)
+class Quality:
+    name: str
+    preview: bool = True
+    rate_scale: int = 1
+
+LEVELS = (Quality('full'),
+          Quality('no preview', preview=False),
+          Quality('half rate', preview=False, rate_scale=2),
+          Quality('quarter rate', preview=False, rate_scale=4),
+         )
+
+@dataclass(frozen=True)
+class Sample:
+    time: float
+    cpu: float = None       # Share of the CPU that was busy (0 - 1) since the last sample
+    temp: float = None      # SoC temperature (C)
+    throttled: int = None   # get_throttled flags
+
+    def describe(self) -> str:
+        parts = []
+        if self.cpu is not None:
+            parts.append(f"cpu {self.cpu:.0%}")
+        if self.temp is not None:
+            parts.append(f"{self.temp:.1f} C")
+        if self.throttled:
+            parts.append(f"throttled 0x{self.throttled:x}")
+        return ', '.join(parts) or 'nothing to read'
+
+def throttle_names(flags: int) -> list:
+    return [name for bit, name in THROTTLE_FLAGS.items() if flags & bit]
+
+class ResourceMonitor:
+    """Samples the CPU load, SoC temperature and throttle flags on a
+    background thread.  Anything this system doesn't have is None."""
+    def __init__(self, root: str = '/', interval: float = SAMPLE_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.latest = None
+        self._cpu_times = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _read(self, path: str) -> str:
+        try:
+            with open(os.path.join(self.root, path), 'r') as fp:
+                return fp.read()
+        except OSError:
+            return None
+
+    def read_cpu(self) -> float:
+        # The first line of /proc/stat is the time every CPU has spent
+        # doing each thing.  idle and iowait are the 4th and 5th.
+        text = self._read(PROC_STAT)
+        if not text or not text.startswith('cpu '):
+            return None
+        times = [int(n) for n in text.split('\n', 1)[0].split()[1:]]
+        idle = sum(times[3:5])
+        total = sum(times)
+        last, self._cpu_times = self._cpu_times, (idle, total)
+        if last is None or total <= last[1]:
+            return None
+        return 1.0 - (idle - last[0]) / (total - last[1])
+
+    def read_temp(self) -> float:
+        text = self._read(THERMAL_ZONE)
+        try:
+            return int(text) / 1000 if text else None
+        except ValueError:
+            return None
+
+    def read_throttled(self) -> int:
+        text = self._read(GET_THROTTLED)
+        try:
+            return int(text.strip(), 16) if text else None
+        except ValueError:
+            return None
+
+    def sample(self) -> Sample:
+        self.latest = Sample(time.monotonic(), self.read_cpu(), self.read_temp(), self.read_throttled())
+        return self.latest
+
+    def start(self) -> None:
+        self.sample()       # Primes the CPU times
+        self._thread = threading.Thread(target=self._run, name="resource-monitor", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                logger.exception("Resource sample failed")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2 * self.interval)
+
+class FrameStats:
+    """How many of the last few frames came out late."""
+    def __init__(self, window: int = FRAME_WINDOW, slack: float = OVERRUN_SLACK):
+        self.slack = slack
+        self._late = deque(maxlen=window)
+        self.frames = 0
+        self.overruns = 0
+
+    def add(self, took_ms: float, target_ms: float) -> None:
+        """took_ms is the time spent working on a frame, target_ms the frame period."""
+        late = took_ms > target_ms * (1 + self.slack)
+        self._late.append(late)
+        self.frames += 1
+        self.overruns += late
+
+    @property
+    def overrun(self) -> float:
+        return sum(self._late) / len(self._late) if self._late else 0.0
+
+    def clear(self) -> None:
+        self._late.clear()
+
+class Governor:
+    """Trades quality for breathing room when the Pi is struggling.
+
+    Under pressure (busy CPU, hot SoC, throttling, late frames) for
+    DEGRADE_AFTER seconds it goes down a level: preview off first, then
+    fewer frames.  Once there's been headroom for RESTORE_AFTER seconds it
+    comes back up a level.  The main loop calls poll() every time around
+    and frame() for every frame, and uses quality to decide what to do.
+    Every change is logged along with why.
+    """
+    def __init__(self, monitor: ResourceMonitor, levels: tuple = LEVELS):
+        if not levels:
+            raise GovernorError("No quality levels")
+        self.monitor = monitor
+        self.levels = levels
+        self.level = 0
+        self.frames = FrameStats()
+        self.decisions = []     # (time, from, to, why)
+
+        now = time.monotonic()
+        self._last = None       # Last sample looked at
+        self._pressure_since = None
+        self._headroom_since = None
+        self._level_since = now
+        self._time_at = Counter()
+
+    @property
+    def quality(self) -> Quality:
+        return self.levels[self.level]
+
+    def frame(self, took_ms: float, target_ms: float) -> None:
+        self.frames.add(took_ms, target_ms)
+
+    def pressure(self, sample: Sample) -> list:
+        """Reasons things are tight (empty if they aren't)."""
+        reasons = []
+        if sample.cpu is not None and sample.cpu >= CPU_HIGH:
+            reasons.append(f"cpu {sample.cpu:.0%}")
+        if sample.temp is not None and sample.temp >= TEMP_HIGH:
+            reasons.append(f"{sample.temp:.1f} C")
+        if sample.throttled and sample.throttled & THROTTLED_NOW:
+            reasons.append(', '.join(throttle_names(sample.throttled)))
+        if self.frames.overrun >= OVERRUN_HIGH:
+            reasons.append(f"{self.frames.overrun:.0%} frames late")
+        return reasons
+
+    def headroom(self, sample: Sample) -> bool:
+        return ((sample.cpu is None or sample.cpu < CPU_LOW)
+                and (sample.temp is None or sample.temp < TEMP_LOW)
+                and not (sample.throttled and sample.throttled & THROTTLED_NOW)
+                and self.frames.overrun < OVERRUN_LOW)
+
+    def poll(self, now: float = None) -> Quality:
+        """Look at the newest sample.  Returns the new Quality if it changed."""
+        sample = self.monitor.latest
+        if sample is None or sample is self._last:
+            return None
+        self._last = sample
+        now = time.monotonic() if now is None else now
+
+        reasons = self.pressure(sample)
+        if reasons:
+            self._headroom_since = None
+            if self._pressure_since is None:
+                self._pressure_since = now
+            if now - self._pressure_since >= DEGRADE_AFTER and self.level < len(self.levels) - 1:
+                return self._change(self.level + 1, now, ', '.join(reasons))
+        elif self.headroom(sample):
+            self._pressure_since = None
+            if self._headroom_since is None:
+                self._headroom_since = now
+            if now - self._headroom_since >= RESTORE_AFTER and self.level > 0:
+                return self._change(self.level - 1, now, f"headroom ({sample.describe()})")
+        else:
+            # Somewhere in between.  Stay put.
+            self._pressure_since = self._headroom_since = None
+        return None
+
+    def _change(self, level: int, now: float, why: str) -> Quality:
+        old = self.quality
+        self._time_at[old.name] += now - self._level_since
+        self.level = level
+        self._level_since = now
+        self._pressure_since = self._headroom_since = None
+        self.frames.clear()     # The old frames were at the old rate
+        self.decisions.append((now, old.name, self.quality.name, why))
+        logger.info(f"{old.name} -> {self.quality.name}: {why}")
+        return self.quality
+
+    def report(self) -> dict:
+        time_at = Counter(self._time_at)
+        time_at[self.quality.name] += time.monotonic() - self._level_since
+        return dict(level=self.quality.name,
+                    changes=len(self.decisions),
+                    seconds={name: round(s, 1) for name, s in time_at.items()},
+                    frames=self.frames.frames,
+                    late=self.frames.overruns)
+
+if __name__ == '__main__':
+    import sys
+    monitor = ResourceMonitor(sys.argv[1] if len(sys.argv) > 1 else '/')
+    monitor.sample()
+    try:
+        while True:
+            time.sleep(SAMPLE_INTERVAL)
+            sample = monitor.sample()
+            names = throttle_names(sample.throttled or 0)
+            print(sample.describe() + (f" ({', '.join(names)})" if names else ''), flush=True)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,280 @@
+import sys
+import json
+import time
+import struct
+import asyncio
+import argparse
+
+from collections import deque
+
+# Probably overkill
+import logging
+logger = logging.getLogger("[OPC Server]")
+
+OPC_HEADER = struct.Struct('>BBH')
+SET_PIXELS = 0
+SYSTEM_EXCLUSIVE = 255
+FADECANDY_ID = 0x0001
+FADECANDY_COLOR_CORRECTION = 0x0001
+FADECANDY_FIRMWARE_CONFIG = 0x0002
+
+# A Fade Candy drives 8 strands of 64 LEDs
+DEVICE_PIXELS = 512
+
+# How many inter-frame times to keep for the stats
+HISTORY = 500
+
+class EmulatorError(Exception): pass
+
+class Device:
+    """An emulated Fade Candy with an fcserver style map.
+
+    Each map entry is [OPC channel, first OPC pixel, first output pixel,
+    pixel count] with an optional colour order string (e.g. "grb") on the
+    end.  The output is the 512 pixels the Fade Candy would drive.
+    """
+    def __init__(self, serial: str, mapping: list):
+        self.serial = serial
+        self.mapping = []
+        for entry in mapping:
+            if len(entry) not in (4, 5):
+                raise EmulatorError(f"Bad map entry {entry} for {serial}")
+            order = entry[4] if len(entry) == 5 else 'rgb'
+            self.mapping.append((entry[0], entry[1], entry[2], entry[3], order))
+            if entry[2] + entry[3] > DEVICE_PIXELS:
+                raise EmulatorError(f"Map entry {entry} runs off the end of {serial}")
+        self.pixels = [(0, 0, 0)] * DEVICE_PIXELS
+        self.interpolation = True
+        self.dithering = True
+
+    def set_pixels(self, channel: int, pixels: list) -> int:
+        """Apply a set pixels message.  Returns the number of pixels mapped."""
+        mapped = 0
+        for map_channel, first, out, count, order in self.mapping:
+            if channel != 0 and channel != map_channel:
+                continue
+            chunk = pixels[first:first + count]
+            if order != 'rgb':
+                chunk = [tuple(px['rgb'.index(c)] for c in order) for px in chunk]
+            self.pixels[out:out + len(chunk)] = chunk
+            mapped += len(chunk)
+        return mapped
+
+    @property
+    def strands(self) -> list:
+        return [self.pixels[ix:ix + 64] for ix in range(0, DEVICE_PIXELS, 64)]
+
+class FrameStats:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.messages = 0
+        self.unmapped = 0
+        self.started = None
+        self.last = None
+        self.intervals = deque(maxlen=HISTORY)
+
+    def frame(self, now: float, size: int) -> None:
+        if self.started is None:
+            self.started = now
+        if self.last is not None:
+            self.intervals.append((now - self.last) * 1000)
+        self.last = now
+        self.frames += 1
+        self.bytes += size
+
+    def report(self) -> dict:
+        elapsed = (self.last - self.started) if self.frames > 1 else 0
+        report = dict(frames=self.frames, messages=self.messages, bytes=self.bytes,
+                      unmapped_pixels=self.unmapped)
+        if elapsed:
+            report['fps'] = round((self.frames - 1) / elapsed, 1)
+            report['bytes_per_s'] = round(self.bytes / elapsed)
+        if self.intervals:
+            ordered = sorted(self.intervals)
+            mean = sum(ordered) / len(ordered)
+            report['interval_ms'] = dict(min=round(ordered[0], 2),
+                                         mean=round(mean, 2),
+                                         p95=round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+                                         max=round(ordered[-1], 2))
+        return report
+
+class Connection:
+    """Parses the OPC stream one client (e.g. opc.Client) sends.
+
+    feed() takes bytes as they come off the socket, so messages split over
+    several reads (or several messages in one read) are fine.  Every
+    client has its own buffer and stats so two of them at once don't get
+    mixed up.
+    """
+    def __init__(self, emulator: 'Emulator', stats: FrameStats):
+        self.emulator = emulator
+        self.stats = stats
+        self._buffer = b''
+
+    def feed(self, data: bytes, now: float = None) -> int:
+        """Returns the number of complete messages handled."""
+        now = time.perf_counter() if now is None else now
+        self._buffer += data
+        handled = 0
+        while len(self._buffer) >= OPC_HEADER.size:
+            channel, command, length = OPC_HEADER.unpack_from(self._buffer)
+            end = OPC_HEADER.size + length
+            if len(self._buffer) < end:
+                break
+            body = self._buffer[OPC_HEADER.size:end]
+            self._buffer = self._buffer[end:]
+            self.emulator.message(channel, command, body, now, self.stats)
+            handled += 1
+        return handled
+
+class Emulator:
+    """Applies OPC messages to the emulated devices and keeps stats for
+    each client that has connected."""
+    def __init__(self, devices: list, record=None):
+        self.devices = devices
+        self.record = record
+        self.stats = {}         # peer -> FrameStats
+
+    def connect(self, peer: str) -> Connection:
+        # A reconnect comes from a new port so it shows up as a new client
+        stats = self.stats.setdefault(peer, FrameStats())
+        return Connection(self, stats)
+
+    def report(self) -> dict:
+        return {peer: stats.report() for peer, stats in self.stats.items()}
+
+    def message(self, channel: int, command: int, body: bytes, now: float, stats: FrameStats) -> None:
+        stats.messages += 1
+        if command == SET_PIXELS:
+            pixels = [tuple(body[ix:ix + 3]) for ix in range(0, len(body) - 2, 3)]
+            mapped = 0
+            for device in self.devices:
+                mapped = max(mapped, device.set_pixels(channel, pixels))
+            stats.unmapped += max(0, len(pixels) - mapped)
+            stats.frame(now, OPC_HEADER.size + len(body))
+            if self.record:
+                self.write_frame(now)
+        elif command == SYSTEM_EXCLUSIVE and len(body) >= 4:
+            system, sysex = struct.unpack_from('>HH', body)
+            if system == FADECANDY_ID and sysex == FADECANDY_FIRMWARE_CONFIG and len(body) >= 5:
+                config = body[4]
+                for device in self.devices:
+                    device.dithering = not (config & 0x01)
+                    device.interpolation = not (config & 0x02)
+                logger.info(f"Firmware config: interpolation={not (config & 0x02)} "
+                            f"dithering={not (config & 0x01)}")
+            elif system == FADECANDY_ID and sysex == FADECANDY_COLOR_CORRECTION:
+                logger.info(f"Color correction: {body[4:].decode(errors='replace')}")
+            else:
+                logger.warning(f"Unknown system exclusive {system:#06x}/{sysex:#06x}")
+        else:
+            logger.warning(f"Unknown OPC command {command} on channel {channel}")
+
+    # Recorded frames are a timestamp (double, seconds) followed by every
+    # device's 512 output pixels.
+    def write_frame(self, now: float) -> None:
+        self.record.write(struct.pack('<d', now))
+        for device in self.devices:
+            self.record.write(bytes(c for px in device.pixels for c in px))
+
+def load_json(config_filename: str) -> list:
+    with open(config_filename, 'r') as fp:
+        cfg = json.load(fp)
+
+    devices = []
+    for ix, entry in enumerate(cfg.get('devices', [])):
+        if entry.get('type', 'fadecandy') != 'fadecandy':
+            continue
+        devices.append(Device(entry.get('serial', f"device{ix}"), entry.get('map', [])))
+    if not devices:
+        raise EmulatorError(f"No Fade Candy devices in {config_filename!r}")
+    return devices
+
+# Shows the strands the way the Fade Candy would drive them: one row per
+# strand, 64 LEDs to a row.  Only imports pygame if you ask for it.
+class Preview:
+    led = 8
+    gap = 2
+
+    def __init__(self, devices: list):
+        import pygame
+        self.pygame = pygame
+        pygame.init()
+        step = self.led + self.gap
+        self.screen = pygame.display.set_mode((64 * step, 8 * step * len(devices)), 0, 32)
+        pygame.display.set_caption("OPC Server Emulator")
+        self.devices = devices
+
+    def draw(self) -> bool:
+        pygame = self.pygame
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                return False
+        step = self.led + self.gap
+        self.screen.fill((0, 0, 0))
+        for dev_ix, device in enumerate(self.devices):
+            for row, strand in enumerate(device.strands):
+                y = (dev_ix * 8 + row) * step
+                for col, color in enumerate(strand):
+                    pygame.draw.rect(self.screen, color, (col * step, y, self.led, self.led))
+        pygame.display.flip()
+        return True
+
+async def serve(emulator: Emulator, host: str, port: int, report: float, preview: Preview = None) -> None:
+    async def client(reader, writer):
+        peer = writer.get_extra_info('peername')
+        logger.info(f"Client connected: {peer}")
+        connection = emulator.connect(f"{peer[0]}:{peer[1]}" if peer else 'unknown')
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            connection.feed(data)
+        logger.info(f"Client disconnected: {peer}")
+        writer.close()
+
+    server = await asyncio.start_server(client, host, port)
+    print(f"Emulating {len(emulator.devices)} Fade Candy on {host}:{port}", flush=True)
+    last = time.monotonic()
+    async with server:
+        while True:
+            await asyncio.sleep(1 / 30)
+            if preview and not preview.draw():
+                break
+            if report and time.monotonic() - last >= report:
+                last = time.monotonic()
+                print(json.dumps(emulator.report()), flush=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='OPC server / Fade Candy emulator')
+    parser.add_argument('config', nargs='?', default='fade_candy_config.json',
+                        help="fcserver style config JSON file")
+    parser.add_argument('--host', action='store', default=None, help='Address to listen on')
+    parser.add_argument('--port', action='store', type=int, default=None, help='Port to listen on')
+    parser.add_argument('--report', action='store', type=float, default=5.0,
+                        help='Seconds between stats reports (0 for none)')
+    parser.add_argument('--record', action='store', default=None,
+                        help='Write every frame the devices would show to this file')
+    parser.add_argument('--render', action='store_true', help='Show the LEDs in a window')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with open(args.config, 'r') as fp:
+        listen = json.load(fp).get('listen', [None, 7890])
+    host = args.host or listen[0] or '127.0.0.1'
+    port = args.port or listen[1]
+
+    devices = load_json(args.config)
+    record = open(args.record, 'wb') if args.record else None
+    emulator = Emulator(devices, record)
+    preview = Preview(devices) if args.render else None
+    try:
+        asyncio.run(serve(emulator, host, port, args.report, preview))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if record:
+            record.close()
+        print(json.dumps(emulator.report(), indent=2))
+        sys.exit(0)
@@ -0,0 +1,300 @@
+"""Open Pixel Control over UDP.
+
+For a light show a late frame is worse than a missing one, and TCP will
+happily hold a frame back behind a lost packet.  DatagramClient sends the
+same OPC messages as opc.Client but one frame per datagram, split into
+fragments when a frame won't fit in the MTU.  Every datagram has a small
+header in front of a normal OPC message:
+
+    magic 'OPCU' | sequence (u32) | fragment | fragments | first pixel (u16s)
+
+The Bridge listens for those, puts the fragments back together, drops
+anything older than the newest complete frame, and forwards what's left to
+a normal TCP OPC server (e.g. fcserver on the same Pi).
+
+    python opc_udp.py --listen 0.0.0.0:7890 --server localhost:7890
+"""
+
+import sys
+import time
+import socket
+import struct
+import argparse
+import threading
+
+# Probably overkill
+import logging
+logger = logging.getLogger("[OPC UDP]")
+
+MAGIC = b'OPCU'
+HEADER = struct.Struct('>4sIHHH')
+OPC_HEADER = struct.Struct('>BBH')
+
+# Ethernet MTU less the IP and UDP headers
+DEFAULT_MTU = 1472
+
+SEQ_MASK = 0xFFFFFFFF
+
+# If nothing has been forwarded for this long (seconds) the sender has
+# probably restarted, so the next frame is taken whatever its number.
+IDLE_RESET = 2.0
+
+# How long to wait before trying a failed name lookup or a dead OPC server
+# again (seconds).  Doubles every failure up to the max.
+RETRY_DELAY = 0.5
+RETRY_MAX = 8.0
+
+def newer(a: int, b: int) -> bool:
+    """True if sequence number a comes after b (allowing for wrap around)."""
+    return a != b and ((a - b) & SEQ_MASK) < 0x80000000
+
+def pack_pixels(pixels: list) -> bytes:
+    return bytes(min(255, max(0, int(c))) for color in pixels for c in color)
+
+class DatagramClient(object):
+
+    def __init__(self, server_ip_port, mtu=DEFAULT_MTU, verbose=False):
+        """Create a UDP OPC client.  Same interface as opc.Client.
+
+        server_ip_port should be an ip:port or hostname:port as a single
+        string pointing at a Bridge.
+        """
+        self.verbose = verbose
+        self.mtu = mtu
+        self._ip, self._port = server_ip_port.split(':')
+        self._port = int(self._port)
+        self._addr = None
+        self._lookup = None     # Thread looking up the host name
+        self._retry_at = 0.0
+        self._delay = RETRY_DELAY
+        self._socket = None
+        self.seq = 0
+        self.dropped = 0
+
+        # Whole pixels only so a fragment never splits a colour
+        self.pixels_per_datagram = (mtu - HEADER.size - OPC_HEADER.size) // 3
+        if self.pixels_per_datagram < 1:
+            raise ValueError(f"MTU of {mtu} is too small")
+
+    def _debug(self, m):
+        if self.verbose:
+            print('    %s' % str(m))
+
+    def _resolve(self):
+        try:
+            self._addr = (socket.gethostbyname(self._ip), self._port)
+        except socket.error as e:
+            self._debug(f'_resolve: {e}')
+            self._retry_at = time.monotonic() + self._delay
+            self._delay = min(RETRY_MAX, self._delay * 2)
+
+    def _ensure_connected(self):
+        if self._socket:
+            return True
+        if self._addr is None:
+            # Name lookups can block for seconds and this is called from
+            # the render loop, so they happen on a thread.  Frames are
+            # dropped until the address is known.
+            try:
+                socket.inet_aton(self._ip)
+                self._addr = (self._ip, self._port)
+            except socket.error:
+                if self._lookup is None or not self._lookup.is_alive():
+                    if time.monotonic() >= self._retry_at:
+                        self._lookup = threading.Thread(target=self._resolve, name='opc-udp-resolve',
+                                                        daemon=True)
+                        self._lookup.start()
+                return False
+        try:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.setblocking(False)
+            return True
+        except socket.error as e:
+            self._debug(f'_ensure_connected: {e}')
+            self._socket = None
+            return False
+
+    def disconnect(self):
+        if self._socket:
+            self._socket.close()
+        self._socket = None
+
+    def can_connect(self):
+        # There's no connection with UDP.  This just checks the name.
+        return self._ensure_connected()
+
+    def _send(self, datagrams):
+        """Send every datagram or none of the rest once one won't go."""
+        for datagram in datagrams:
+            try:
+                self._socket.sendto(datagram, self._addr)
+            except BlockingIOError:
+                # Socket buffer is full: drop the frame rather than wait
+                self.dropped += 1
+                self._debug('_send: would block.  dropping frame.')
+                return False
+            except socket.error as e:
+                self._debug(f'_send: {e}')
+                self.disconnect()
+                return False
+        return True
+
+    def put_pixels(self, pixels, channel=0):
+        if not self._ensure_connected():
+            return False
+
+        self.seq = (self.seq + 1) & SEQ_MASK
+        step = self.pixels_per_datagram
+        count = max(1, (len(pixels) + step - 1) // step)
+        datagrams = []
+        for ix in range(count):
+            chunk = pack_pixels(pixels[ix * step:(ix + 1) * step])
+            datagrams.append(HEADER.pack(MAGIC, self.seq, ix, count, ix * step) +
+                             OPC_HEADER.pack(channel, 0, len(chunk)) + chunk)
+        return self._send(datagrams)
+
+    def set_interpolation(self, enabled=True):
+        if not self._ensure_connected():
+            return False
+
+        # Same firmware configuration message opc.Client sends
+        config_bit = 0 if enabled else 2
+        message = struct.pack('BBBBBBBBB', 0, 255, 0, 5, 0, 1, 0, 2, config_bit)
+        self.seq = (self.seq + 1) & SEQ_MASK
+        return self._send([HEADER.pack(MAGIC, self.seq, 0, 1, 0) + message])
+
+class Bridge:
+    """Receives DatagramClient frames and forwards them to a TCP OPC server."""
+    def __init__(self, listen: tuple, server: tuple):
+        self.listen = listen
+        self.server = server
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(listen)
+        self.tcp = None
+        self.retry_at = 0.0
+        self.delay = RETRY_DELAY
+
+        self.latest = None      # Newest frame sent on to the server
+        self._building = None   # (seq, fragment count, {fragment: (offset, channel, data)})
+
+        # A restarted client numbers its frames from 1 again (from a new
+        # port), so a new sender or a quiet spell starts the count afresh.
+        self.sender = None
+        self._last_forward = 0.0
+
+        self.stats = dict(datagrams=0, forwarded=0, stale=0, incomplete=0, bad=0, resets=0,
+                          disconnected=0)
+
+    def _forward(self, message: bytes) -> None:
+        if self.tcp is None:
+            # While the server is down frames are dropped rather than
+            # waiting on a connect for every one of them
+            now = time.monotonic()
+            if now < self.retry_at:
+                self.stats['disconnected'] += 1
+                return
+            try:
+                self.tcp = socket.create_connection(self.server, timeout=1.0)
+                self.tcp.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.delay = RETRY_DELAY
+            except OSError as e:
+                if self.delay == RETRY_DELAY:
+                    logger.warning(f"Could not connect to {self.server}: {e}")
+                self.tcp = None
+                self.stats['disconnected'] += 1
+                self.retry_at = time.monotonic() + self.delay
+                self.delay = min(RETRY_MAX, self.delay * 2)
+                return
+        try:
+            self.tcp.sendall(message)
+            self.stats['forwarded'] += 1
+        except OSError as e:
+            logger.warning(f"Lost connection to {self.server}: {e}")
+            self.tcp.close()
+            self.tcp = None
+
+    def receive(self, datagram: bytes, sender: tuple = None, now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+        self.stats['datagrams'] += 1
+        if len(datagram) < HEADER.size + OPC_HEADER.size:
+            self.stats['bad'] += 1
+            return
+        magic, seq, fragment, count, offset = HEADER.unpack_from(datagram)
+        if magic != MAGIC or fragment >= count:
+            self.stats['bad'] += 1
+            return
+
+        if sender != self.sender or now - self._last_forward > IDLE_RESET:
+            if self.latest is not None:
+                logger.info(f"Starting over with frames from {sender}")
+                self.stats['resets'] += 1
+            self.sender = sender
+            self.latest = None
+            self._building = None
+            self._last_forward = now
+
+        # Anything older than what we've already sent is too late
+        if self.latest is not None and not newer(seq, self.latest):
+            self.stats['stale'] += 1
+            return
+
+        message = datagram[HEADER.size:]
+        if count == 1:
+            self._abandon(seq)
+            self.latest = seq
+            self._last_forward = now
+            self._forward(message)
+            return
+
+        if self._building is None or newer(seq, self._building[0]):
+            self._abandon(seq)
+            self._building = (seq, count, {})
+        elif seq != self._building[0]:
+            self.stats['stale'] += 1
+            return
+
+        channel, _, length = OPC_HEADER.unpack_from(message)
+        self._building[2][fragment] = (offset, channel, message[OPC_HEADER.size:])
+        if len(self._building[2]) == count:
+            parts = sorted(self._building[2].values())
+            data = b''.join(part[2] for part in parts)
+            self._building = None
+            self.latest = seq
+            self._last_forward = now
+            self._forward(OPC_HEADER.pack(parts[0][1], 0, len(data)) + data)
+
+    def _abandon(self, seq: int) -> None:
+        # A newer frame showed up before this one was finished
+        if self._building is not None and self._building[0] != seq:
+            self.stats['incomplete'] += 1
+            self._building = None
+
+    def run(self, report: float = 10.0) -> None:
+        logger.info(f"Bridging UDP {self.listen} to TCP {self.server}")
+        last = time.monotonic()
+        while True:
+            datagram, sender = self.sock.recvfrom(65535)
+            self.receive(datagram, sender)
+            if report and time.monotonic() - last > report:
+                last = time.monotonic()
+                print(self.stats, flush=True)
+
+def split_address(address: str) -> tuple:
+    host, port = address.split(':')
+    return host, int(port)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='OPC UDP to TCP bridge')
+    parser.add_argument('--listen', action='store', default='0.0.0.0:7890',
+                        help='Address to listen for UDP frames on')
+    parser.add_argument('--server', action='store', default='localhost:7890',
+                        help='TCP OPC server to forward frames to')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    bridge = Bridge(split_address(args.listen), split_address(args.server))
+    try:
+        bridge.run()
+    except KeyboardInterrupt:
+        print(bridge.stats)
+        sys.exit(0)
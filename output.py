@@ -0,0 +1,285 @@
+import sys
+import json
+import time
+import errno
+import socket
+import struct
+import selectors
+import threading
+
+# Probably overkill
+import logging
+logger = logging.getLogger("[Output]")
+
+# How long to wait before trying a dead endpoint again (seconds).  Doubles
+# every failure up to the max so a missing server doesn't cost anything.
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX = 8.0
+
+# Give up on a connect that hasn't finished after this long (seconds)
+CONNECT_TIMEOUT = 2.0
+
+class OutputError(Exception): pass
+
+def opc_message(pixels: list, channel: int = 0) -> bytes:
+    """Build an OPC 'set pixel colours' message (same format as opc.py)."""
+    data = bytes(min(255, max(0, int(c))) for color in pixels for c in color)
+    return struct.pack('>BBH', channel, 0, len(data)) + data
+
+class Endpoint:
+    """One OPC server and the bits of the framebuffer that go to it.
+
+    The map is a list of [first framebuffer pixel, first device pixel, count]
+    entries, a bit like the fcserver config.  Sockets are non-blocking.  If
+    the endpoint can't keep up we only ever hold on to the newest frame.
+    """
+    def __init__(self, name: str, host: str, port: int, mapping: list, channel: int = 0):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.channel = channel
+        self.mapping = [tuple(m) for m in mapping]
+        self.size = max(dst + count for _, dst, count in self.mapping)
+
+        self.addr = None        # Looked up on the first connect
+        self._lookup = None     # Thread looking up the host name
+        self._looked_up = None  # (address, error) from the lookup
+        self.sock = None
+        self.connected = False
+        self.connect_started = 0.0
+        self.retry_at = 0.0
+        self.delay = RECONNECT_DELAY
+
+        self._sending = b''     # Partly sent message.  Has to be finished.
+        self._pending = None    # Newest message waiting to go out
+        self._control = []      # Control messages.  Go before the next frame and never dropped.
+        self.config = None      # Firmware config, sent again on every connect
+
+        self.stats = dict(frames=0, dropped=0, bytes=0, connects=0, failures=0)
+
+    def build(self, pixels: list) -> bytes:
+        out = [(0, 0, 0)] * self.size
+        for src, dst, count in self.mapping:
+            chunk = pixels[src:src + count]
+            out[dst:dst + len(chunk)] = chunk
+        return opc_message(out, self.channel)
+
+    def queue(self, message: bytes) -> None:
+        if self._pending is not None:
+            self.stats['dropped'] += 1
+        self._pending = message
+
+    def configure(self, message: bytes) -> None:
+        """Send a firmware config message now and after every reconnect."""
+        self.config = message
+        if self.connected:
+            self._control.append(message)
+        # Otherwise it goes out when the connect finishes
+
+    @property
+    def wants_write(self) -> bool:
+        return (bool(self._sending) or self._pending is not None or bool(self._control)
+                or (self.config is not None and not self.connected))
+
+    def connect(self, now: float) -> bool:
+        """Start a non-blocking connect if it's time.  Returns True if started."""
+        if self.sock is not None or now < self.retry_at:
+            return False
+        if self.addr is None and not self.resolve(now):
+            return False
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect_started = now
+        err = self.sock.connect_ex(self.addr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self.fail(now, OSError(err, errno.errorcode.get(err, 'connect failed')))
+            return False
+        return True
+
+    def resolve(self, now: float) -> bool:
+        """Look up the host name without blocking.  Returns True once the
+        address is known.
+
+        A lookup can block for seconds (a .local name with nobody answering)
+        and this runs on the render thread, so it happens on a thread of its
+        own and connect() checks back on it.  Only done until it works once.
+        """
+        try:
+            socket.inet_aton(self.host)
+            self.addr = (self.host, self.port)
+            return True
+        except OSError:
+            pass
+        if self._lookup is None:
+            self._looked_up = None
+            self._lookup = threading.Thread(target=self._resolve, name=f"resolve-{self.name}", daemon=True)
+            self._lookup.start()
+            return False
+        if self._lookup.is_alive():
+            return False
+        self._lookup = None
+        addr, error = self._looked_up
+        if error is not None:
+            self.fail(now, error)
+            return False
+        self.addr = (addr, self.port)
+        return True
+
+    def _resolve(self) -> None:
+        try:
+            self._looked_up = (socket.gethostbyname(self.host), None)
+        except OSError as e:
+            self._looked_up = (None, e)
+
+    def fail(self, now: float, error: Exception) -> None:
+        if self.connected or self.stats['failures'] == 0:
+            logger.warning(f"{self.name} ({self.host}:{self.port}): {error}")
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+        self.connected = False
+        self._sending = b''
+        self.stats['failures'] += 1
+        self.retry_at = now + self.delay
+        self.delay = min(RECONNECT_MAX, self.delay * 2)
+
+    def writable(self, now: float) -> None:
+        if not self.connected:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self.fail(now, OSError(err, errno.errorcode.get(err, 'connect failed')))
+                return
+            self.connected = True
+            self.delay = RECONNECT_DELAY
+            self.stats['connects'] += 1
+            logger.info(f"{self.name}: connected to {self.host}:{self.port}")
+            # The server (or the Fade Candy behind it) may have restarted
+            if self.config is not None:
+                self._control = [self.config] + [m for m in self._control if m != self.config]
+
+        if not self._sending and self._control:
+            self._sending = self._control.pop(0)
+        elif not self._sending and self._pending is not None:
+            self._sending, self._pending = self._pending, None
+        if not self._sending:
+            return
+        try:
+            sent = self.sock.send(self._sending)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.fail(now, e)
+            return
+        self.stats['bytes'] += sent
+        self._sending = self._sending[sent:]
+        if not self._sending:
+            self.stats['frames'] += 1
+
+    def close(self) -> None:
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+        self.connected = False
+
+class OutputRouter:
+    """Splits the framebuffer over several OPC servers.
+
+    Has the same put_pixels() as opc.Client so it can be dropped in where
+    the client was.  Sending never blocks: whatever the sockets will take
+    right now goes out and the rest waits for the next pump().
+    """
+    def __init__(self, endpoints: list):
+        if not endpoints:
+            raise OutputError("No output endpoints")
+        self.endpoints = list(endpoints)
+        self.selector = selectors.DefaultSelector()
+
+    def put_pixels(self, pixels: list, channel: int = 0) -> bool:
+        for ep in self.endpoints:
+            ep.queue(ep.build(pixels))
+        self.pump()
+        return any(ep.connected for ep in self.endpoints)
+
+    def set_interpolation(self, enabled: bool = True) -> bool:
+        # Same firmware config message opc.Client sends
+        config_bit = 0 if enabled else 2
+        message = struct.pack('BBBBBBBBB', 0, 255, 0, 5, 0, 1, 0, 2, config_bit)
+        for ep in self.endpoints:
+            ep.configure(message)
+        self.pump()
+        return any(ep.connected for ep in self.endpoints)
+
+    def pump(self, timeout: float = 0.0) -> None:
+        """Push out whatever the sockets will take without blocking."""
+        now = time.monotonic()
+        for ep in self.endpoints:
+            if ep.sock is None and ep.wants_write:
+                ep.connect(now)
+            elif ep.sock is not None and not ep.connected:
+                if now - ep.connect_started > CONNECT_TIMEOUT:
+                    ep.fail(now, TimeoutError("connect timed out"))
+
+        # Endpoints can drop their socket in writable() so hang on to the
+        # ones we registered.  The selector copes with them being closed.
+        registered = []
+        for ep in self.endpoints:
+            if ep.sock is not None and (ep.wants_write or not ep.connected):
+                self.selector.register(ep.sock, selectors.EVENT_WRITE, ep)
+                registered.append(ep.sock)
+        if not registered:
+            return
+        try:
+            for key, _ in self.selector.select(timeout):
+                key.data.writable(now)
+        finally:
+            for sock in registered:
+                self.selector.unregister(sock)
+
+    def flush(self, timeout: float = 1.0) -> None:
+        """Try for up to timeout seconds to get everything sent."""
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            busy = [ep for ep in self.endpoints if ep.wants_write and ep.sock is not None]
+            if not busy:
+                break
+            self.pump(min(0.05, max(0.0, end - time.monotonic())))
+
+    def locate(self, pixel: int) -> list:
+        """Where a framebuffer pixel goes: [(endpoint name, device pixel), ...]"""
+        return [(ep.name, dst + pixel - src) for ep in self.endpoints
+                for src, dst, count in ep.mapping if src <= pixel < src + count]
+
+    def disconnect(self) -> None:
+        for ep in self.endpoints:
+            ep.close()
+
+    def report(self) -> dict:
+        return {ep.name: dict(ep.stats, connected=ep.connected) for ep in self.endpoints}
+
+def load_json(map_filename: str) -> OutputRouter:
+    with open(map_filename, 'r') as fp:
+        cfg = json.load(fp)
+
+    endpoints = []
+    for ix, entry in enumerate(cfg.get('endpoints', [])):
+        for required in ('host', 'map'):
+            if required not in entry:
+                raise OutputError(f"Output Error: Missing {required} in endpoint {ix}")
+        if not entry['map']:
+            raise OutputError(f"Output Error: Empty map in endpoint {ix}")
+        for m in entry['map']:
+            if len(m) != 3 or min(m) < 0:
+                raise OutputError(f"Output Error: Bad map entry {m} in endpoint {ix}")
+        endpoints.append(Endpoint(entry.get('name', f"endpoint{ix}"),
+                                  entry['host'],
+                                  int(entry.get('port', 7890)),
+                                  entry['map'],
+                                  int(entry.get('channel', 0))))
+    return OutputRouter(endpoints)
+
+if __name__ == '__main__':
+    router = load_json(sys.argv[1])
+    for ep in router.endpoints:
+        print(f"{ep.name}: {ep.host}:{ep.port} {ep.size} pixels {ep.mapping}")
@@ -0,0 +1,233 @@
+import time
+import queue
+import struct
+import multiprocessing as mp
+
+from multiprocessing import shared_memory
+
+# Probably overkill
+import logging
+logger = logging.getLogger("[Pipeline]")
+
+RING_SLOTS = 4
+
+# How often the consumers look for a new frame (seconds)
+POLL_INTERVAL = 0.001
+
+# Frames go through a small ring buffer in shared memory.  The header holds
+# the sequence number of the last frame written and every slot starts with
+# the sequence number of the frame in it.  The writer bumps the slot number
+# after copying the frame in so a reader can tell if it got a torn frame
+# (the number changed under it) and just try again.
+#
+#   [ latest seq ][ slot seq | frame bytes ][ slot seq | frame bytes ] ...
+#
+class FrameRing:
+    _seq = struct.Struct('<Q')
+
+    def __init__(self, frame_size: int, slots: int = RING_SLOTS, name: str = None):
+        self.frame_size = frame_size
+        self.slots = slots
+        self.slot_size = self._seq.size + frame_size
+        size = self._seq.size + self.slot_size * slots
+
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.buf = self.shm.buf
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    @property
+    def latest(self) -> int:
+        return self._seq.unpack_from(self.buf, 0)[0]
+
+    def _slot(self, seq: int) -> int:
+        return self._seq.size + (seq % self.slots) * self.slot_size
+
+    def write(self, frame: bytes) -> int:
+        seq = self.latest + 1
+        offset = self._slot(seq)
+        self._seq.pack_into(self.buf, offset, 0)    # Mark the slot as busy
+        self.buf[offset + self._seq.size:offset + self.slot_size] = frame
+        self._seq.pack_into(self.buf, offset, seq)
+        self._seq.pack_into(self.buf, 0, seq)
+        return seq
+
+    def read(self, seq: int = None) -> tuple:
+        """Return (seq, frame) for frame seq (default: the newest one).
+
+        Returns (0, None) if that frame has already been overwritten or
+        nothing has been written yet.
+        """
+        for _ in range(self.slots):
+            want = self.latest if seq is None else seq
+            if want == 0:
+                return 0, None
+            offset = self._slot(want)
+            if self._seq.unpack_from(self.buf, offset)[0] != want:
+                if seq is not None:
+                    return 0, None
+                continue
+            frame = bytes(self.buf[offset + self._seq.size:offset + self.slot_size])
+            if self._seq.unpack_from(self.buf, offset)[0] == want:
+                return want, frame
+        return 0, None
+
+    def close(self) -> None:
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def pack_pixels(pixels: list) -> bytes:
+    return bytes(min(255, max(0, int(c))) for color in pixels for c in color)
+
+def unpack_pixels(frame: bytes) -> list:
+    return [tuple(frame[ix:ix + 3]) for ix in range(0, len(frame), 3)]
+
+def wait_for_frame(ring: FrameRing, last: int, stop) -> tuple:
+    """Block until there's a frame newer than last (or stop is set)."""
+    while not stop.is_set():
+        if ring.latest != last:
+            seq, frame = ring.read()
+            if frame is not None:
+                return seq, frame
+        time.sleep(POLL_INTERVAL)
+    return last, None
+
+# Runs the animation in its own process.  Mode changes, light cues and
+# animation settings come in on the control queue as (command, value) tuples.
+def render_worker(ring_name: str, frame_size: int, control, stop, verbose: bool = False) -> None:
+    import boat as ship     # Here to keep the import out of the parent
+
+    ring = FrameRing(frame_size, name=ring_name)
+    dragon = ship.Boat(verbose)
+    try:
+        last = time.perf_counter()
+        while not stop.is_set():
+            while True:
+                try:
+                    command, value = control.get_nowait()
+                except queue.Empty:
+                    break
+                if command == 'mode':
+                    dragon.mode = value
+                elif command == 'cue':
+                    dragon.cue(value)
+                elif command == 'configure':
+                    dragon.configure(value)
+
+            now = time.perf_counter()
+            dragon.update(int((now - last) * 1000))
+            last = now
+            ring.write(pack_pixels(dragon.pixels))
+
+            rate = 1.0 / ship.RATES[dragon.mode]
+            time.sleep(max(0.0, rate - (time.perf_counter() - now)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ring.close()
+
+# Sends the newest frame to the OPC server whenever one shows up.  On the
+# way out it does the same fade out the single process version does.
+def output_worker(ring_name: str, frame_size: int, host: str, port: int, stop) -> None:
+    import opc
+    import boat as ship
+
+    ring = FrameRing(frame_size, name=ring_name)
+    layout = ship.Boat()     # Only used to turn frames into strands
+    client = opc.Client(f'{host}:{port}')
+    strands = [ship.OFF] * 8
+    try:
+        seq = 0
+        while not stop.is_set():
+            seq, frame = wait_for_frame(ring, seq, stop)
+            if frame is None:
+                break
+            layout.pixels = unpack_pixels(frame)
+            strands = layout.strands
+            client.put_pixels(sum(strands, []))
+            if not ship.TEMPORAL_DITHERING:
+                client.put_pixels(sum(strands, []))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        quit_fade = [(0, 0, 0)] * 512
+        client.put_pixels(sum(strands, []))
+        time.sleep(ship.FADE_TIME / 1000.0)
+        client.put_pixels(quit_fade)
+        time.sleep(ship.FADE_TIME / 1000.0)
+        client.put_pixels(quit_fade)
+        client.put_pixels(quit_fade)
+        ring.close()
+
+class Pipeline:
+    """Runs the animation and OPC output in their own processes.
+
+    The UI process (pygame events, sound and the preview window) talks to
+    the render process through a queue and reads frames out of the ring
+    buffer just like the output process does.
+    """
+    def __init__(self, n_leds: int, host: str = None, port: int = None, verbose: bool = False):
+        self.frame_size = n_leds * 3
+        self.ring = FrameRing(self.frame_size)
+        self.control = mp.Queue()
+        self.stop_event = mp.Event()
+        self.last_seq = 0
+
+        self.renderer = mp.Process(target=render_worker, name="render",
+                                   args=(self.ring.name, self.frame_size,
+                                         self.control, self.stop_event, verbose))
+        self.output = None
+        if host is not None:
+            self.output = mp.Process(target=output_worker, name="output",
+                                     args=(self.ring.name, self.frame_size,
+                                           host, port, self.stop_event))
+
+    def start(self) -> None:
+        self.renderer.start()
+        if self.output:
+            self.output.start()
+        logger.info(f"Pipeline started with ring buffer {self.ring.name}")
+
+    def set_mode(self, mode: str) -> None:
+        self.control.put(('mode', mode))
+
+    def cue(self, light) -> None:
+        self.control.put(('cue', light))
+
+    def configure(self, settings: dict) -> None:
+        self.control.put(('configure', settings))
+
+    def latest(self) -> list:
+        """The newest frame as Boat.pixels, or None if nothing new."""
+        if self.ring.latest == self.last_seq:
+            return None
+        seq, frame = self.ring.read()
+        if frame is None:
+            return None
+        self.last_seq = seq
+        return unpack_pixels(frame)
+
+    def stop(self) -> None:
+        """Tell the workers to finish up.  The output fades the LEDs out."""
+        self.stop_event.set()
+
+    def join(self, timeout: float = 5.0) -> None:
+        self.stop()
+        for proc in (self.renderer, self.output):
+            if proc is None:
+                continue
+            proc.join(timeout)
+            if proc.is_alive():
+                logger.warning(f"{proc.name} process didn't stop.  Killing it.")
+                proc.terminate()
+                proc.join()
+        self.control.close()
+        self.ring.close()
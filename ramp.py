@@ -0,0 +1,93 @@
+import time
+import threading
+
+# Probably overkill
+import logging
+logger = logging.getLogger("[Ramp]")
+
+# How often the background timer moves the ramps along (ms)
+TICK = 10
+
+def now_ms() -> float:
+    return time.monotonic() * 1000
+
+class Ramps:
+    """A set of named levels that move to new values over time.
+
+    Setting a level starts a straight line ramp from wherever it is now.
+    tick() moves every running ramp along in one pass and returns the names
+    that changed, so the owner can push all of them out at once (e.g. set
+    every channel volume once even if the master and a channel both moved).
+    Safe to use from more than one thread.
+    """
+    def __init__(self, **levels):
+        self.values = dict(levels)
+        self._ramps = dict()    # name -> (start time, start value, target, duration)
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> float:
+        return self.values[name]
+
+    def target(self, name: str) -> float:
+        """Where the level is heading (its value if it isn't moving)."""
+        ramp = self._ramps.get(name)
+        return ramp[2] if ramp else self.values[name]
+
+    @property
+    def active(self) -> bool:
+        return bool(self._ramps)
+
+    def ramp(self, name: str, target: float, ms: float, now: float = None) -> None:
+        now = now_ms() if now is None else now
+        with self._lock:
+            if ms <= 0:
+                # Still goes through tick() so the change gets applied
+                self._ramps[name] = (now, target, target, 0)
+            else:
+                self._ramps[name] = (now, self.values[name], target, ms)
+
+    def tick(self, now: float = None) -> set:
+        now = now_ms() if now is None else now
+        changed = set()
+        with self._lock:
+            for name, (start, level, target, ms) in list(self._ramps.items()):
+                frac = min(1.0, (now - start) / ms) if ms > 0 else 1.0
+                value = target if frac >= 1.0 else level + (target - level) * frac
+                if value != self.values[name]:
+                    self.values[name] = value
+                    changed.add(name)
+                if frac >= 1.0:
+                    del self._ramps[name]
+        return changed
+
+class RampTimer:
+    """Calls tick() every TICK ms on a background thread while it says so.
+
+    tick() returns True while there's more to do.  kick() wakes the timer
+    up again after something new has been started.
+    """
+    def __init__(self, tick, interval: int = TICK, name: str = "ramps"):
+        self.tick = tick
+        self.interval = interval / 1000
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def kick(self) -> None:
+        self._wake.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                while not self._stop.is_set() and self.tick():
+                    time.sleep(self.interval)
+            except Exception:
+                logger.exception("Ramp tick failed")
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=1.0)
@@ -0,0 +1,436 @@
+import sys
+import time
+import zlib
+import struct
+import argparse
+
+import numpy as np
+
+import boat as ship
+
+# Probably overkill
+import logging
+logger = logging.getLogger("[Render]")
+
+# Frames are in Boat.pixels order: left waves, right waves, left rail,
+# right rail, then the Larson scanner (up the left side of the bow and
+# back down the right).
+N_WAVE = ship.WAVE_SIZE
+N_RAIL = ship.RAIL_SIZE - ship.KITT_SIZE
+N_KITT = ship.KITT_SIZE * 2
+WAVES = slice(0, 2 * N_WAVE)
+RAILS = slice(2 * N_WAVE, 2 * N_WAVE + 2 * N_RAIL)
+KITT = slice(2 * N_WAVE + 2 * N_RAIL, 2 * N_WAVE + 2 * N_RAIL + N_KITT)
+LEDS = KITT.stop
+
+# Where the scanner turns round (see Boat.boat()).  It sits on each end
+# for two frames so a full sweep there and back is 2 * KITT_TOP frames.
+KITT_TOP = (ship.KITT_SIZE - 2) * 2
+
+# The white flashes the america scanner leaves on the last few rail LEDs
+STRIPE = 6
+
+# How many frames to work on at once.  Keeps a night's worth of frames
+# from needing gigabytes.
+CHUNK = 4096
+
+# Packed frame file: magic, version, frames per second, LEDs per frame and
+# the number of frames, then the frames as raw RGB bytes.
+FRAME_MAGIC = b'DSFR'
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct('<4sHHII')
+
+# Contact sheet layout (pixels)
+SHEET_LED = 3       # Each LED is drawn this big, plus a one pixel gap
+SHEET_MARGIN = 12
+SHEET_BACKGROUND = (32, 32, 32)
+
+class RenderError(Exception): pass
+
+def animation_settings(config=None) -> dict:
+    """The Boat's animation settings with any from a sound board config on top."""
+    settings = dict(rail_level=ship.Boat.rail_level[0],
+                    rail_decay=ship.Boat.rail_decay,
+                    rail_prob=ship.Boat.rail_prob,
+                    wave_level=ship.Boat.wave_level)
+    if config is not None:
+        settings.update(config.animation)
+    return settings
+
+def kitt_sweep(k: np.ndarray) -> tuple:
+    """Scanner position and direction after frame k (counting from 1)."""
+    m = (k - 1) % (2 * KITT_TOP)
+    pos = np.where(m < KITT_TOP, m + 1, 2 * KITT_TOP - m)
+    direction = np.where(m < KITT_TOP, 1, -1)
+    return pos, direction
+
+def last_bounce(s: np.ndarray, first: int) -> np.ndarray:
+    """The last frame <= s the scanner turned round at the end it first
+    reaches on frame first, or 0 if it hasn't yet."""
+    last = s - (s - first) % (2 * KITT_TOP)
+    return np.where(last >= first, last, 0)
+
+class Renderer:
+    """Renders a Boat mode without pygame's display or any hardware.
+
+    The frames come out of render() as a (frames, LEDs, 3) array, a chunk
+    at a time.  The parts of the animations that only depend on time (the
+    waves, the scanner, the collision lights, the america fades and
+    stripes) are worked out for every frame and LED in one go.  The random
+    parts (rail speckles, disco) use a seeded numpy generator so the same
+    seed gives the same frames every time.  They don't match what the live
+    boat does with the random module, but they look the same.
+    """
+    def __init__(self, mode: str, settings: dict = None, seed: int = 0):
+        renderers = dict(boat=self._boat, speed_boat=self._boat, fast_boat=self._boat,
+                         dragon=self._dragon, space=self._dragon,
+                         america=self._america,
+                         disco=self._disco, panic=self._disco, slow=self._slow,
+                         debug=self._debug, off=self._off, bright=self._bright)
+        if mode not in renderers or mode not in ship.RATES:
+            raise RenderError(f"Don't know how to render {mode!r}")
+        self.mode = mode
+        self.rate = ship.RATES[mode]
+        self._render = renderers[mode]
+
+        settings = animation_settings() if settings is None else settings
+        self.rail_level = settings['rail_level']
+        self.rail_decay = settings['rail_decay']
+        self.rail_prob = settings['rail_prob']
+        self.wave_level = settings['wave_level']
+        self.rng = np.random.default_rng(seed)
+
+        # What carries over from one chunk to the next
+        self.frames = 0
+        self.wave_offset = 0.0
+        self._spot_frame = np.zeros((2, N_RAIL), np.int64)     # 0 for never
+        self._spot_value = np.zeros((2, N_RAIL), np.int64)
+        self._held = None
+        self._usa = None
+
+    def initial(self) -> np.ndarray:
+        """The LEDs of a freshly made Boat."""
+        pixels = np.empty((LEDS, 3), np.uint8)
+        pixels[WAVES] = (0, 0, self.wave_level)
+        pixels[RAILS] = self.rail_level
+        pixels[KITT] = ship.Boat.kitt_dark
+        return pixels
+
+    def render(self, count: int) -> np.ndarray:
+        k = np.arange(self.frames + 1, self.frames + count + 1)
+        out = np.empty((count, LEDS, 3), np.uint8)
+        self._render(k, out)
+        self.frames += count
+        return out
+
+    def __iter__(self):
+        while True:
+            yield self.render(CHUNK)
+
+    def _waves(self, k: np.ndarray, out: np.ndarray) -> None:
+        # cumsum adds the 0.31s up one at a time like Boat.boat() does, so
+        # the offsets (and so the colours) are the same to the last bit
+        steps = np.full(len(k) + 1, 0.31)
+        steps[0] = self.wave_offset
+        t = np.cumsum(steps)[1:, None]
+        self.wave_offset = t[-1, 0]
+        ix = np.arange(N_WAVE)
+        level = self.wave_level + np.sin(t + ix) * 64 + np.sin(t + (ix >> 2)) * 24
+        chop = level > 255
+        wave = np.empty(level.shape + (3,), np.uint8)
+        wave[..., 0] = wave[..., 1] = np.where(chop, 255, 0)
+        wave[..., 2] = np.where(chop, 255, level).astype(np.uint8)
+        out[:, :N_WAVE] = wave
+        out[:, N_WAVE:2 * N_WAVE] = wave
+
+    def _speckles(self, k: np.ndarray, out: np.ndarray) -> None:
+        # A spot is set to white (grey either side) then fades by rail_decay
+        # a frame down to rail_level.  So each LED only depends on the last
+        # spot that landed on it and how long ago that was.
+        count = len(k)
+        for side in range(2):
+            spots = np.nonzero(self.rng.random(count) < self.rail_prob)[0]
+            dots = self.rng.integers(1, N_RAIL - 1, len(spots))
+            value = np.zeros((count, N_RAIL), np.int64)
+            value[spots, dots - 1] = 200
+            value[spots, dots + 1] = 200
+            value[spots, dots] = 255
+
+            landed = np.where(value > 0, k[:, None], 0)
+            landed[0] = np.maximum(landed[0], self._spot_frame[side])
+            landed = np.maximum.accumulate(landed, axis=0)
+            first = k[0]
+            row = np.clip(landed - first, 0, None)
+            spot = np.where(landed >= first, np.take_along_axis(value, row, axis=0),
+                            self._spot_value[side])
+            spot = np.where(landed > 0, spot, self.rail_level)
+            age = k[:, None] - landed
+            grey = np.where(age == 0, spot, np.maximum(self.rail_level, spot - self.rail_decay * age))
+            self._spot_frame[side] = landed[-1]
+            self._spot_value[side] = spot[-1]
+
+            rail = RAILS.start + side * N_RAIL
+            out[:, rail:rail + N_RAIL] = grey[..., None]
+
+    def _indicators(self, out: np.ndarray) -> None:
+        # Red on the left, green on the right
+        for side, color in enumerate(((255, 0, 0), (0, 255, 0))):
+            rail = RAILS.start + side * N_RAIL
+            for ix in (*range(ship.STERN_SIZE, ship.STERN_SIZE + 3),
+                       *range(ship.PROW - 2, ship.PROW + 1)):
+                out[:, rail + ix] = color
+
+    def _kitt(self, k: np.ndarray, out: np.ndarray, lit: tuple, half: tuple) -> None:
+        pos, direction = kitt_sweep(k)
+        pos, direction = pos[:, None], direction[:, None]
+        ix = np.arange(N_KITT)
+        scanner = np.broadcast_to(np.array(ship.Boat.kitt_dark, np.uint8), (len(k), N_KITT, 3)).copy()
+        scanner[(ix >= pos) & (ix < pos + ship.Boat.kitt_size)] = lit
+        scanner[ix == np.where(direction == 1, pos + ship.Boat.kitt_size, pos - 1)] = half
+        out[:, KITT] = scanner
+
+    def _boat(self, k: np.ndarray, out: np.ndarray, alt_mode: str = None) -> None:
+        self._waves(k, out)
+        self._speckles(k, out)
+        if alt_mode is None:
+            self._kitt(k, out, (255, 0, 0), (192, 0, 0))
+        else:
+            out[:, KITT] = 255
+        self._indicators(out)
+
+    def _dragon(self, k: np.ndarray, out: np.ndarray) -> None:
+        self._boat(k, out, alt_mode=self.mode)
+
+    def _america_waves(self) -> tuple:
+        # Every wave LED is the same colour, fading 5 a frame towards red,
+        # white then blue and sitting still for a frame before moving on.
+        # After the first fade to red it goes round the same cycle forever,
+        # so work out the start and one cycle and index into them.
+        def fade(color, target):
+            color, target = np.array(color), np.array(target)
+            steps = int(np.ceil(np.abs(target - color).max() / 5))
+            j = np.arange(1, steps + 1)[:, None]
+            frames = color + np.clip(target - color, -5 * j, 5 * j)
+            return np.concatenate([frames, target[None]])     # The frame it sits still
+
+        usa = [(255, 0, 0), (255, 255, 255), (0, 0, 255)]
+        start = fade((0, 0, self.wave_level), usa[0])
+        cycle = np.concatenate([fade(usa[ix], usa[(ix + 1) % 3]) for ix in range(3)])
+        return start.astype(np.uint8), cycle.astype(np.uint8)
+
+    def _america(self, k: np.ndarray, out: np.ndarray) -> None:
+        if self._usa is None:
+            self._usa = self._america_waves()
+        start, cycle = self._usa
+        ix = k - 1
+        waves = np.where((ix < len(start))[:, None],
+                         start[np.minimum(ix, len(start) - 1)],
+                         cycle[(ix - len(start)) % len(cycle)])
+        out[:, WAVES] = waves[:, None]
+
+        self._kitt(k, out, (255, 255, 255), (192, 192, 192))
+
+        # The rails are a shift register.  Every frame the end LED gets red
+        # (left) or blue (right), or a white stripe when the scanner turns
+        # round at that end, and everything moves along one.  So an LED
+        # shows what was written back when that colour was at the end,
+        # unless a white stripe came along since.
+        last = N_RAIL - 1
+        ix = np.arange(N_RAIL)[None, :]
+        kk = k[:, None]
+        written = ix + 1 + kk - last               # When it was at the end
+        stripe = np.minimum(kk, ix + 1 + kk - (last - STRIPE + 1))
+        for side, (color, first) in enumerate((((255, 0, 0), 2 * KITT_TOP + 1),
+                                               ((0, 0, 255), KITT_TOP + 1))):
+            white = last_bounce(stripe, first) >= np.maximum(written, 1)
+            white[:, last] = last_bounce(k, first) == k
+            rail = np.empty((len(k), N_RAIL, 3), np.uint8)
+            rail[...] = self.rail_level
+            rail[written >= 1] = color
+            rail[:, last] = color
+            rail[white] = 255
+            start = RAILS.start + side * N_RAIL
+            out[:, start:start + N_RAIL] = rail
+
+    def _disco(self, k: np.ndarray, out: np.ndarray) -> None:
+        out[...] = self.rng.integers(0, 256, out.shape, dtype=np.uint8)
+
+    def _slow(self, k: np.ndarray, out: np.ndarray) -> None:
+        # A new disco frame every sixth frame, held in between
+        new = np.nonzero((k - 1) % 6 == 0)[0]
+        frames = self.rng.integers(0, 256, (len(new), LEDS, 3), dtype=np.uint8)
+        if self._held is None:
+            self._held = self.initial()
+        held = np.concatenate([self._held[None], frames])
+        which = np.searchsorted(new, np.arange(len(k)), side='right')
+        out[...] = held[which]
+        self._held = out[-1].copy()
+
+    def _debug(self, k: np.ndarray, out: np.ndarray) -> None:
+        out[...] = self.initial()
+
+    def _off(self, k: np.ndarray, out: np.ndarray) -> None:
+        out[...] = 0
+
+    def _bright(self, k: np.ndarray, out: np.ndarray) -> None:
+        out[...] = 255
+
+def reference(mode: str, count: int, settings: dict = None) -> np.ndarray:
+    """Renders count frames the slow way, through a real Boat."""
+    boat = ship.Boat()
+    boat.configure(settings or {})
+    boat.mode = mode
+    frames = np.empty((count, LEDS, 3), np.uint8)
+    for ix in range(count):
+        boat.update(int(1000 / ship.RATES[mode]))
+        frames[ix] = np.asarray(boat.pixels, dtype=np.float64).astype(np.uint8)
+    return frames
+
+def check(mode: str, count: int = 500) -> int:
+    """Compare the fast renderer against the Boat.  The random bits are
+    turned off so the two should agree.  Returns the biggest difference."""
+    settings = dict(animation_settings(), rail_prob=0.0)
+    fast = Renderer(mode, settings)
+    frames = np.concatenate([fast.render(n) for n in (count // 3, count - count // 3)])
+    slow = reference(mode, count, settings)
+    return int(np.abs(frames.astype(np.int16) - slow).max())
+
+def physical_map() -> np.ndarray:
+    """The (column, row) of each LED, as laid out in the boat's window."""
+    step = ship.LED_SIZE + ship.LED_GAP
+    boat = ship.Boat()
+    return np.array([(led.rect.x // step, led.rect.y // step)
+                     for strip in boat.strips for led in strip])
+
+def write_frames(fp, rate: int, frames: int) -> None:
+    """Write the frame file header.  The frames go straight after it."""
+    fp.write(FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, rate, LEDS, frames))
+
+def read_frames(filename: str) -> tuple:
+    """Load a frame file.  Returns (frames per second, frames array)."""
+    with open(filename, 'rb') as fp:
+        magic, version, rate, leds, count = FRAME_HEADER.unpack(fp.read(FRAME_HEADER.size))
+        if magic != FRAME_MAGIC or version != FRAME_VERSION:
+            raise RenderError(f"{filename!r} isn't a version {FRAME_VERSION} frame file")
+        frames = np.fromfile(fp, dtype=np.uint8, count=count * leds * 3)
+    return rate, frames.reshape(count, leds, 3)
+
+def write_png(filename: str, image: np.ndarray) -> None:
+    """Just enough PNG (8 bit RGB, one IDAT) to not need anything installed."""
+    height, width, _ = image.shape
+    raw = np.zeros((height, width * 3 + 1), np.uint8)     # Filter byte 0 on each row
+    raw[:, 1:] = image.reshape(height, -1)
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+    with open(filename, 'wb') as fp:
+        fp.write(b'\x89PNG\r\n\x1a\n')
+        fp.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        fp.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)))
+        fp.write(chunk(b'IEND', b''))
+
+def contact_sheet(frames: np.ndarray, columns: int, led: int = SHEET_LED) -> np.ndarray:
+    """Lay frames out on a grid, each one drawn as the boat looks from above."""
+    cells = physical_map()
+    cell = led + 1
+    thumb_w = (cells[:, 0].max() + 1) * cell
+    thumb_h = (cells[:, 1].max() + 1) * cell
+    rows = -(-len(frames) // columns)
+    sheet = np.empty((SHEET_MARGIN + rows * (thumb_h + SHEET_MARGIN),
+                      SHEET_MARGIN + columns * (thumb_w + SHEET_MARGIN), 3), np.uint8)
+    sheet[...] = SHEET_BACKGROUND
+
+    for n, frame in enumerate(frames):
+        top = SHEET_MARGIN + (n // columns) * (thumb_h + SHEET_MARGIN)
+        left = SHEET_MARGIN + (n % columns) * (thumb_w + SHEET_MARGIN)
+        for dy in range(led):
+            for dx in range(led):
+                sheet[top + cells[:, 1] * cell + dy, left + cells[:, 0] * cell + dx] = frame
+    return sheet
+
+def timeline(frames: np.ndarray, width: int = 2) -> np.ndarray:
+    """One row per frame, one column (width pixels wide) per LED."""
+    return np.repeat(frames, width, axis=1)
+
+def pick(total: int, count: int) -> np.ndarray:
+    """count frame numbers spread evenly over total frames."""
+    return np.unique(np.linspace(0, total - 1, min(total, count)).astype(int))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Render a boat mode to a frame file and previews')
+    parser.add_argument('mode', action='store', help='Animation mode to render')
+    parser.add_argument('duration', action='store', type=float, help='How long to render (seconds)')
+    parser.add_argument('-o', '--output', action='store', default=None,
+                        help='Packed frame file to write')
+    parser.add_argument('--sheet', action='store', default=None,
+                        help='Contact sheet PNG of frames picked evenly over the render')
+    parser.add_argument('--thumbs', action='store', type=int, default=24,
+                        help='Number of frames on the contact sheet')
+    parser.add_argument('--columns', action='store', type=int, default=4,
+                        help='Contact sheet columns')
+    parser.add_argument('--timeline', action='store', default=None,
+                        help='PNG with a row per frame and a column per LED')
+    parser.add_argument('--rows', action='store', type=int, default=2000,
+                        help='Most rows in the timeline (frames are skipped to fit)')
+    parser.add_argument('--seed', action='store', type=int, default=0,
+                        help='Seed for the random parts (rail speckles, disco)')
+    parser.add_argument('--config', action='store', default=None,
+                        help='Sound board config to take the animation settings from')
+    parser.add_argument('--check', action='store_true',
+                        help='Compare against the real Boat animations first')
+    return parser.parse_args()
+
+def main(args) -> None:
+    settings = animation_settings()
+    if args.config:
+        import sound_board
+        settings = animation_settings(sound_board.load_config(args.config))
+
+    if args.check:
+        diff = check(args.mode)
+        print(f"Check {args.mode!r}: largest difference from the Boat is {diff}", flush=True)
+
+    renderer = Renderer(args.mode, settings, args.seed)
+    total = int(args.duration * renderer.rate)
+    if total < 1:
+        raise RenderError(f"{args.duration} s is less than a frame at {renderer.rate} fps")
+    thumbs = pick(total, args.thumbs) if args.sheet else np.array([], int)
+    rows = pick(total, args.rows) if args.timeline else np.array([], int)
+    kept_thumbs, kept_rows = [], []
+
+    start = time.perf_counter()
+    fp = open(args.output, 'wb') if args.output else None
+    try:
+        if fp:
+            write_frames(fp, renderer.rate, total)
+        done = 0
+        while done < total:
+            chunk = renderer.render(min(CHUNK, total - done))
+            if fp:
+                fp.write(chunk.tobytes())
+            for wanted, kept in ((thumbs, kept_thumbs), (rows, kept_rows)):
+                ix = wanted[(wanted >= done) & (wanted < done + len(chunk))]
+                kept.append(chunk[ix - done])
+            done += len(chunk)
+    finally:
+        if fp:
+            fp.close()
+    elapsed = time.perf_counter() - start
+    print(f"Rendered {total} frames of {args.mode!r} ({total / renderer.rate:.1f} s at "
+          f"{renderer.rate} fps) in {elapsed:.2f} s ({total / max(elapsed, 1e-6):.0f} frames/s)",
+          flush=True)
+
+    if args.sheet:
+        write_png(args.sheet, contact_sheet(np.concatenate(kept_thumbs), args.columns))
+        print(f"Contact sheet: {args.sheet} ({len(thumbs)} frames)")
+    if args.timeline:
+        write_png(args.timeline, timeline(np.concatenate(kept_rows)))
+        print(f"Timeline: {args.timeline} ({len(rows)} of {total} frames)")
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except RenderError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,109 @@
+from dataclasses import dataclass
+
+# A very small schema checker for the JSON config files.  The point is to
+# find every problem with a config in one go rather than fixing them one
+# exception at a time on a Pi in the dark.
+
+class SchemaError(Exception):
+    def __init__(self, errors: list):
+        self.errors = list(errors)
+        super().__init__("\n  ".join(["Config Error:"] + self.errors))
+
+@dataclass(frozen=True)
+class Field:
+    type: type
+    required: bool = False
+    default: object = None
+    check: object = None        # check(value) -> error message or None
+    schema: 'Schema' = None     # For nested objects
+    items: 'Schema' = None      # For lists of objects
+
+def _type_ok(value, kind) -> bool:
+    # JSON doesn't tell ints and bools apart the way Python does
+    if kind is float:
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+    if kind is int:
+        return isinstance(value, int) and not isinstance(value, bool)
+    return isinstance(value, kind)
+
+class Schema:
+    def __init__(self, fields: dict, strict: bool = True):
+        self.fields = fields
+        self.strict = strict
+
+    def validate(self, data, path: str = '') -> tuple:
+        """Check data against the schema.
+
+        Returns (values, errors) where values has every field filled in
+        (defaults for the missing ones) and errors is a list of strings.
+        """
+        errors = []
+        values = {}
+        if not isinstance(data, dict):
+            return values, [f"{path or 'config'}: expected an object"]
+
+        if self.strict:
+            for name in data:
+                if name not in self.fields:
+                    errors.append(f"{path}{name}: unknown field")
+
+        for name, field in self.fields.items():
+            where = f"{path}{name}"
+            if name not in data or data[name] is None:
+                if field.required:
+                    errors.append(f"{where}: missing")
+                values[name] = field.default
+                continue
+
+            value = data[name]
+            if not _type_ok(value, field.type):
+                errors.append(f"{where}: expected {field.type.__name__}, got {value!r}")
+                values[name] = field.default
+                continue
+
+            if field.schema is not None:
+                value, errs = field.schema.validate(value, f"{where}.")
+                errors += errs
+            elif field.items is not None:
+                items = []
+                for ix, item in enumerate(value):
+                    if not isinstance(item, dict):
+                        # Kept as None so the ones after keep their index
+                        errors.append(f"{where}[{ix}]: must be an object")
+                        items.append(None)
+                        continue
+                    item, errs = field.items.validate(item, f"{where}[{ix}].")
+                    items.append(item)
+                    errors += errs
+                value = items
+            elif field.check is not None:
+                err = field.check(value)
+                if err:
+                    errors.append(f"{where}: {err}")
+            values[name] = value
+        return values, errors
+
+# Some common checks
+def between(low: float, high: float):
+    def check(value):
+        if not (low <= value <= high):
+            return f"must be between {low} and {high} (got {value})"
+    return check
+
+def at_least(low: float):
+    def check(value):
+        if value < low:
+            return f"must be at least {low} (got {value})"
+    return check
+
+def power_of_two(low: int, high: int):
+    def check(value):
+        if not (low <= value <= high) or value & (value - 1):
+            return f"must be a power of two from {low} to {high} (got {value})"
+    return check
+
+def one_of(options: tuple):
+    def check(value):
+        if value not in options:
+            return f"must be one of {options} (got {value!r})"
+    return check
@@ -0,0 +1,273 @@
+import sys
+import json
+import random
+
+from dataclasses import dataclass
+
+import pygame
+
+# Probably overkill
+import logging
+logger = logging.getLogger("[Show]")
+
+# Default buffer size pygame uses for the mixer.  Sound we start now isn't
+# actually heard until the buffer drains so light cues are pushed back by
+# this much to line up with what the audience hears.
+DEFAULT_MIXER_BUFFER = 512
+
+class ShowError(Exception): pass
+
+@dataclass(frozen=True)
+class Cue:
+    time: int                   # ms from the start of the show
+    mode: str = None            # Switch the animation routine
+    brightness: float = None    # Target brightness (0.1 - 1.0)
+    ramp: int = 0               # ms to ramp the brightness over
+    key: str = None             # Act like someone pressed this key
+    effect: str = None          # Filename of an effect to play
+    ambient: str = None         # Filename of an ambient to play
+
+    @property
+    def is_sound(self) -> bool:
+        return self.key is not None or self.effect is not None or self.ambient is not None
+
+    @property
+    def is_light(self) -> bool:
+        return self.mode is not None or self.brightness is not None
+
+@dataclass(frozen=True)
+class Segment:
+    start: int                  # ms from the start of the show
+    duration: int               # ms
+    mode: str
+    seed: int = 0
+
+@dataclass(frozen=True)
+class Show:
+    cues: tuple[Cue, ...]
+    segments: tuple[Segment, ...] = ()
+    loop: bool = False
+
+    @property
+    def length(self) -> int:
+        ends = [c.time + c.ramp for c in self.cues]
+        ends += [s.start + s.duration for s in self.segments]
+        return max(ends, default=0)
+
+# A pre-rendered chunk of animation.  Each frame is the colour of every LED
+# in Boat.strips order (see Boat.pixels) so playback is just a copy.
+class FrameCache:
+    def __init__(self, segment: Segment, frames: list, rate: int):
+        self.segment = segment
+        self.frames = frames
+        self.rate = rate
+
+    def frame_at(self, t: int) -> list:
+        ix = int((t - self.segment.start) * self.rate / 1000)
+        return self.frames[min(ix, len(self.frames) - 1)]
+
+def prerender(segment: Segment, boat_factory, rates: dict) -> FrameCache:
+    """Render a deterministic segment ahead of time.
+
+    The boat animations use the global random module so we seed it for
+    the segment and put the old state back when we're done.
+    """
+    if segment.mode not in rates:
+        raise ShowError(f"Unknown mode {segment.mode!r} in segment at {segment.start} ms")
+
+    rate = rates[segment.mode]
+    n_frames = max(1, int(segment.duration * rate / 1000))
+    state = random.getstate()
+    try:
+        random.seed(segment.seed)
+        boat = boat_factory()
+        boat.mode = segment.mode
+        frames = []
+        for _ in range(n_frames):
+            boat.update(int(1000 / rate))
+            frames.append(boat.pixels)
+    finally:
+        random.setstate(state)
+
+    logger.info(f"Pre-rendered {n_frames} frames of {segment.mode!r} at {segment.start} ms")
+    return FrameCache(segment, frames, rate)
+
+# Runs a show against the main loop's clock.  The main loop calls wait()
+# instead of pygame.time.wait() so sound cues can be started at their exact
+# time rather than on the next frame, then update() to apply light cues.
+class Sequencer:
+    def __init__(self, show: Show, sounds, caches: tuple = (), audio_latency: int = None):
+        self.show = show
+        self.sounds = sounds
+        self.caches = tuple(caches)
+
+        if audio_latency is None:
+            audio_latency = mixer_latency()
+        self.audio_latency = audio_latency
+
+        # Look up the sounds now so a typo in the show file fails at load
+        # time rather than in the middle of the show.
+        self._effects = {}
+        self._ambients = {}
+        for cue in show.cues:
+            if cue.effect is not None:
+                found = [e for e in sounds.effects if e.filename == cue.effect]
+                if not found:
+                    raise ShowError(f"Show effect not in sound board: {cue.effect!r}")
+                self._effects[cue.effect] = found[0]
+            if cue.ambient is not None:
+                found = [a for a in sounds.ambients if a.filename == cue.ambient]
+                if not found:
+                    raise ShowError(f"Show ambient not in sound board: {cue.ambient!r}")
+                self._ambients[cue.ambient] = found[0]
+
+        self._sound_cues = sorted([c for c in show.cues if c.is_sound], key=lambda c: c.time)
+        self._light_cues = sorted([c for c in show.cues if c.is_light], key=lambda c: c.time)
+        self.restart()
+
+    def restart(self) -> None:
+        self.clock = 0
+        self._next_sound = 0
+        self._next_light = 0
+        self._ramp = None      # (start_ms, start_level, cue)
+
+    @property
+    def finished(self) -> bool:
+        return (self._next_sound >= len(self._sound_cues) and
+                self._next_light >= len(self._light_cues) and
+                self._ramp is None and
+                self.clock >= self.show.length + self.audio_latency)
+
+    def _fire_sounds(self) -> None:
+        while self._next_sound < len(self._sound_cues):
+            cue = self._sound_cues[self._next_sound]
+            if cue.time > self.clock:
+                break
+            logger.info(f"{self.clock} ms: sound cue {cue}")
+            if cue.key is not None:
+                self.sounds.key_press(cue.key)
+            if cue.effect is not None:
+                self.sounds.play_effect(self._effects[cue.effect])
+            if cue.ambient is not None:
+                self.sounds.play_ambient(self._ambients[cue.ambient])
+            self._next_sound += 1
+
+    def wait(self, ms: int, sleep=pygame.time.wait) -> int:
+        """Wait for ms milliseconds, firing sound cues on time along the way.
+
+        sleep(ms) does the actual waiting and returns how long it took, so
+        the caller can keep handling input in the meantime.  Returns the
+        number of milliseconds that actually passed.  Gives up early if
+        sleep stops waiting (the input returns straight away once it's
+        quitting) rather than spinning until ms is up.
+        """
+        elapsed = 0
+        self._fire_sounds()
+        while elapsed < ms:
+            step = ms - elapsed
+            if self._next_sound < len(self._sound_cues):
+                until_cue = self._sound_cues[self._next_sound].time - self.clock
+                step = max(1, min(step, until_cue))
+            dt = sleep(step)
+            if dt <= 0:
+                break
+            elapsed += dt
+            self.clock += dt
+            self._fire_sounds()
+        return elapsed
+
+    def update(self, boat) -> bool:
+        """Apply any light cues that are due.
+
+        Returns True if the boat was drawn from a pre-rendered cache and
+        should not run its own animation this frame.
+        """
+        # Lights run behind the clock by the mixer latency so they line
+        # up with when the sound comes out of the speakers.
+        t = self.clock - self.audio_latency
+
+        while self._next_light < len(self._light_cues):
+            cue = self._light_cues[self._next_light]
+            if cue.time > t:
+                break
+            logger.info(f"{self.clock} ms: light cue {cue}")
+            if cue.mode is not None:
+                boat.mode = cue.mode
+            if cue.brightness is not None:
+                if cue.ramp > 0:
+                    self._ramp = (cue.time, boat.brightness, cue)
+                else:
+                    self._ramp = None
+                    set_brightness(boat, cue.brightness)
+            self._next_light += 1
+
+        if self._ramp is not None:
+            start, level, cue = self._ramp
+            frac = min(1.0, (t - start) / cue.ramp)
+            set_brightness(boat, level + (cue.brightness - level) * frac)
+            if frac >= 1.0:
+                self._ramp = None
+
+        if self.show.loop and self.finished:
+            self.restart()
+
+        for cache in self.caches:
+            seg = cache.segment
+            if seg.start <= t < seg.start + seg.duration:
+                boat.pixels = cache.frame_at(t)
+                return True
+        return False
+
+# Show ramps run on the show clock, so they set the boat's brightness level
+# directly (cancelling any keypad ramp) rather than starting a ramp of their own.
+def set_brightness(boat, level: float) -> None:
+    boat.levels.ramp('brightness', level, 0)
+    boat.tick_levels()
+
+def mixer_latency(buffer: int = DEFAULT_MIXER_BUFFER) -> int:
+    """Estimate (in ms) how long the mixer takes to get sound out."""
+    init = pygame.mixer.get_init()
+    if not init:
+        return 0
+    frequency = init[0]
+    return int(buffer * 1000 / frequency)
+
+def load_json(show_filename: str, modes: set = None) -> Show:
+    with open(show_filename, 'r') as fp:
+        cfg = json.load(fp)
+
+    cues = []
+    for entry in cfg.get('cues', []):
+        if 'time' not in entry:
+            raise ShowError(f"Show Error: Missing time in cue {entry}")
+        unknown = set(entry) - set(Cue.__dataclass_fields__)
+        if unknown:
+            raise ShowError(f"Show Error: Unknown cue fields {sorted(unknown)} at {entry['time']} ms")
+        cue = Cue(**entry)
+        if cue.time < 0 or cue.ramp < 0:
+            raise ShowError(f"Show Error: Negative time in cue at {cue.time} ms")
+        if modes is not None and cue.mode is not None and cue.mode not in modes:
+            raise ShowError(f"Show Error: Unknown mode {cue.mode!r} at {cue.time} ms")
+        if cue.brightness is not None and not (0.0 <= cue.brightness <= 1.0):
+            raise ShowError(f"Show Error: Invalid brightness ({cue.brightness}) at {cue.time} ms")
+        if not (cue.is_sound or cue.is_light):
+            raise ShowError(f"Show Error: Cue at {cue.time} ms does nothing")
+        cues.append(cue)
+
+    segments = []
+    for entry in cfg.get('segments', []):
+        for required in ('start', 'duration', 'mode'):
+            if required not in entry:
+                raise ShowError(f"Show Error: Missing {required} in segment {entry}")
+        segment = Segment(entry['start'], entry['duration'], entry['mode'], entry.get('seed', 0))
+        if modes is not None and segment.mode not in modes:
+            raise ShowError(f"Show Error: Unknown mode {segment.mode!r} in segment at {segment.start} ms")
+        segments.append(segment)
+
+    return Show(tuple(cues), tuple(segments), bool(cfg.get('loop', False)))
+
+if __name__ == '__main__':
+    from pprint import pprint
+    show = load_json(sys.argv[1])
+    pprint(show)
+    print(f"Length: {show.length} ms")
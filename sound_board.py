@@ -1,16 +1,43 @@
 import sys
 import os
+import io
 import json
+import time
+import pickle
 import random
+import hashlib
+import threading
 
 from typing import Union
 from dataclasses import dataclass
-from collections import defaultdict
+from collections import defaultdict, Counter
 
 import pygame
 
+from ramp import Ramps, RampTimer
+from events import LatencyStats
+from schema import Schema, Field, SchemaError, between, at_least, one_of, power_of_two
+
 DEFAULT_CHANNELS = 8
 DEFAULT_IGNORE_CASE = True
+DEFAULT_CROSSFADE = 0
+DEFAULT_PREFETCH = True
+DEFAULT_VOICES = 0
+DEFAULT_STEAL = 'oldest'
+STEAL_ORDERS = ('oldest', 'quietest')
+
+# pygame's mixer defaults.  The buffer is how many samples the mixer works
+# on at a time; a sound started now isn't heard until the current buffer has
+# gone out, so a smaller buffer means less lag (and more CPU).  256 is a
+# good low latency setting on a Pi 4.
+DEFAULT_MIXER = dict(frequency=44100, size=-16, channels=2, buffer=512)
+
+# How long (ms) a volume change takes so it doesn't jump
+DEFAULT_VOLUME_RAMP = 150
+
+# Posted when the music finishes or a queued track takes over, so the main
+# loop wakes up to queue the one after.
+MUSIC_END = pygame.USEREVENT + 1
 
 # Probably overkill
 import logging
@@ -18,6 +45,16 @@ logger = logging.getLogger("[Sound Board]")
 
 class SoundError(Exception): pass
 
+LIGHT_CUES = ('flash', 'mode', 'fire')
+
+# A light cue that goes with a sound.  When the sound starts the cue is
+# published on the sound board's event bus (if it has one).
+@dataclass(frozen=True)
+class LightCue:
+    cue: str
+    duration: int = 0       # ms, 0 means a mode change sticks
+    mode: str = None        # Only for 'mode' cues
+
 @dataclass(frozen=True)
 class Ambient:
     filename: str
@@ -26,6 +63,8 @@ class Ambient:
     loops: int = -1.0
     volume: float = 1.0
     fade_in: int = 0
+    light: LightCue = None
+    mode: str = None
 
 @dataclass(frozen=True)
 class Effect:
@@ -36,31 +75,209 @@ class Effect:
     retrigger: bool = False
     volume: float = 1.0
     fade_in: int = 0
+    light: LightCue = None
+    priority: int = 0       # Only for pooled effects (channel None)
+    polyphony: int = 1      # Copies that can play at once (pooled only)
+    duck: bool = False      # Turn the ambient down while this plays
+
+# Turns the ambient down to level (over attack ms) while an effect with
+# duck set is playing and back up (over release ms) once they're all done.
+@dataclass(frozen=True)
+class Ducking:
+    level: float = 0.3
+    attack: int = 100
+    release: int = 800
+
+def init_mixer(settings: dict = None) -> dict:
+    """Start the mixer (if it isn't already) and return its settings.
+
+    The settings only count the first time it starts, and pygame.init()
+    starts it with the defaults, so do this before pygame.init().
+    """
+    mixer = dict(DEFAULT_MIXER, **(settings or {}))
+    if not pygame.mixer.get_init():
+        pygame.mixer.init(**mixer)
+    frequency, size, stereo = pygame.mixer.get_init()
+    if (frequency, size, stereo) != (mixer['frequency'], mixer['size'], mixer['channels']):
+        logger.warning(f"Mixer is running at {frequency} Hz, {size} bits, {stereo} channels "
+                       f"rather than {mixer}")
+    return dict(mixer, frequency=frequency, size=size, channels=stereo)
+
+class VoicePool:
+    """Hands out mixer channels to effects that don't have one of their own.
+
+    A free channel is used if there is one.  If not, the voice playing the
+    lowest priority effect is stolen (the oldest or quietest of those), as
+    long as it's no more important than the new effect.  Otherwise the new
+    effect doesn't play.
+
+    The ramp timer checks what's playing (for ducking) while the main
+    thread hands out voices, so everything that touches the voices holds
+    the lock.
+    """
+    def __init__(self, channels: tuple, steal: str = DEFAULT_STEAL):
+        if steal not in STEAL_ORDERS:
+            raise SoundError(f"Voice stealing must be one of {STEAL_ORDERS}")
+        self.channels = channels
+        self.steal = steal
+        self._voices = [None] * len(channels)   # (effect, sound, started) per channel
+        self._lock = threading.RLock()
+
+        # For sizing the pool: how many voices were busy at each trigger
+        self.usage = Counter()
+        self.stats = dict(played=0, stolen=0, dropped=0, peak=0)
+
+    def _active(self, ix: int) -> bool:
+        voice = self._voices[ix]
+        if voice is None:
+            return False
+        chan = self.channels[ix]
+        if chan.get_busy() and chan.get_sound() == voice[1]:
+            return True
+        self._voices[ix] = None
+        return False
+
+    def playing(self, effect: Effect) -> list:
+        """Channel indexes playing effect, oldest first."""
+        with self._lock:
+            found = [ix for ix in range(len(self.channels))
+                     if self._active(ix) and self._voices[ix][0] == effect]
+            return sorted(found, key=lambda ix: self._voices[ix][2])
+
+    def busy(self) -> int:
+        with self._lock:
+            return sum(self._active(ix) for ix in range(len(self.channels)))
+
+    def _cost(self, ix: int) -> tuple:
+        effect, sound, started = self._voices[ix]
+        if self.steal == 'quietest':
+            return (effect.priority, sound.get_volume() * self.channels[ix].get_volume(), started)
+        return (effect.priority, started)
+
+    def allocate(self, effect: Effect) -> int:
+        """A channel index for effect, or None if nothing can be freed up."""
+        with self._lock:
+            self.usage[self.busy()] += 1
+            for ix in range(len(self.channels)):
+                if not self._active(ix):
+                    return ix
+
+            victims = [ix for ix in range(len(self.channels))
+                       if self._voices[ix][0].priority <= effect.priority]
+            if not victims:
+                self.stats['dropped'] += 1
+                logger.info(f"No voice for {effect.filename} (priority {effect.priority})")
+                return None
+            ix = min(victims, key=self._cost)
+            logger.info(f"Stealing voice {ix} from {self._voices[ix][0].filename}")
+            self.channels[ix].stop()
+            self._voices[ix] = None
+            self.stats['stolen'] += 1
+            return ix
+
+    def play(self, ix: int, effect: Effect, sound: pygame.mixer.Sound) -> None:
+        with self._lock:
+            self.channels[ix].play(sound, loops=effect.loops, fade_ms=effect.fade_in)
+            self._voices[ix] = (effect, sound, time.perf_counter())
+            self.stats['played'] += 1
+            self.stats['peak'] = max(self.stats['peak'], self.busy())
+
+    def remap(self, effects: dict) -> None:
+        """Hand voices playing an old effect over to its edited version
+        (old effect -> new effect) so they still count as playing it."""
+        with self._lock:
+            for ix, voice in enumerate(self._voices):
+                if voice is not None and voice[0] in effects:
+                    self._voices[ix] = (effects[voice[0]],) + voice[1:]
+
+    def report(self) -> dict:
+        triggers = sum(self.usage.values())
+        mean = sum(n * count for n, count in self.usage.items()) / triggers if triggers else 0.0
+        return dict(self.stats, voices=len(self.channels), steal=self.steal,
+                    mean_busy=round(mean, 2), usage=dict(sorted(self.usage.items())))
 
 class SoundBoard:
     def __init__(self, 
                  channels: int = 8,
                  ignore_case: bool = True,
-                 logging_level: int = logging.CRITICAL):
+                 logging_level: int = logging.CRITICAL,
+                 crossfade: int = DEFAULT_CROSSFADE,
+                 voices: int = DEFAULT_VOICES,
+                 steal: str = DEFAULT_STEAL,
+                 mixer: dict = None,
+                 volume_ramp: int = DEFAULT_VOLUME_RAMP,
+                 ducking: Ducking = None,
+                 shuffle: bool = False):
         logging.basicConfig(level=logging_level)
 
-        pygame.mixer.init()
-        pygame.mixer.set_num_channels(channels)
+        # How long a sound takes to come out of the speakers once started
+        # (ms) and how long it takes from a key press.
+        mixer = init_mixer(mixer)
+        self.output_latency = mixer['buffer'] * 1000 / mixer['frequency']
+        self.latency = LatencyStats()
+
+        # The voice pool's channels come after the fixed ones
+        pygame.mixer.set_num_channels(channels + voices)
         ch = pygame.mixer.get_num_channels()
-        if ch < channels:
-            raise SoundError(f"Tried to allocate {channels} channels but only got {ch}")
+        if ch < channels + voices:
+            raise SoundError(f"Tried to allocate {channels + voices} channels but only got {ch}")
         self.channels = tuple([pygame.mixer.Channel(i) for i in range(channels)])
+        self.pool = None
+        if voices:
+            self.pool = VoicePool(tuple([pygame.mixer.Channel(i) 
+                                         for i in range(channels, channels + voices)]), steal)
         self.ignore_case = ignore_case
         logging.info(f"Allocated {ch} sound channels")
+
+        # Levels that ramp rather than jump.  The channel volume is
+        # master * its gain and the music is the ambient's own volume *
+        # master * ambient * duck.  A background timer moves them along so
+        # they're smooth even when the frames are slow.
+        self.volume_ramp = volume_ramp
+        self.ducking = ducking
+        self.levels = Ramps(master=1.0, ambient=1.0, duck=1.0,
+                            **{f"gain{ix}": 1.0 for ix in range(len(self.all_channels))})
+        self._timer = RampTimer(self.tick_levels, name="sound-ramps")
         
         self._ambients = []
         self._effects = dict()
         self._keys = defaultdict(list)
+        self._modes = dict()
+
+        # A mode with more than one ambient plays them one after another.
+        # While one plays the next is queued up behind it (from memory if
+        # it's been read in) so it starts with no gap.  _last is the track
+        # each mode played last so coming back to a mode moves on.
+        self.shuffle = shuffle
+        self._playlists = defaultdict(list)     # mode -> ambients
+        self._last = dict()
+        self._queued = None         # Next track, waiting for its file
+        self._queue_sent = False    # It's been handed to the mixer
+        self._music_pos = -1
+        pygame.mixer.music.set_endevent(MUSIC_END)
+
+        # Ambient files read into memory in the background so switching
+        # doesn't have to wait on the SD card.
+        self._buffers = dict()
+        self._prefetcher = None
+
+        # Switching ambients fades the old one out then the new one in.
+        # The new one is started from update() once the old one is gone.
+        self.crossfade = crossfade
+        self._pending = None        # (start_time, ambient)
 
         self.control_keys = dict()
         self.paused = False
         self.current_ambient = None
 
+        # The BoardConfig this board was built from (if any) and the modes
+        # passed to index_modes(), so a reload can do the same again.
+        self.config = None
+        self._mode_names = ()
+
+        # Set to an events.EventBus to have light cues published
+        self.bus = None
+
     @property
     def keys(self):
         return self._keys
@@ -72,28 +289,45 @@ class SoundBoard:
     @property
     def effects(self):
         return self._effects
+
+    @property
+    def modes(self):
+        return self._modes
+
+    @property
+    def all_channels(self) -> tuple:
+        """The fixed channels and the voice pool's."""
+        return self.channels + (self.pool.channels if self.pool else ())
     
-    def add_effect(self, effect: Effect):
-        if not (0 <= effect.channel < len(self.channels)):
+    def load_effect(self, effect: Effect) -> pygame.mixer.Sound:
+        if effect.channel is None:
+            if self.pool is None:
+                raise SoundError(f"No channel for {effect.filename} and no voice pool")
+            if effect.polyphony < 1:
+                raise SoundError(f"Invalid polyphony ({effect.polyphony}) for {effect.filename!r}")
+        elif not (0 <= effect.channel < len(self.channels)):
             raise SoundError(f"Invalid channel {effect.channel} for {effect.filename}")
         if not (0.0 <= effect.volume <= 1.0):
             raise SoundError(f"Invalid volume ({effect.volume}) for {effect.filename!r}")
         if effect.fade_in < 0:
             raise SoundError(f"Invalid fade_in ({effect.fade_in} ms) for {effect.filename!r}")
-        
+        sound = pygame.mixer.Sound(effect.filename)
+        sound.set_volume(effect.volume)
+        return sound
+
+    def add_effect(self, effect: Effect):
         key = effect.key.lower() if self.ignore_case else effect.key
         if key in self.control_keys:
             raise SoundError(f"Control {key!r} already in use for {self.control_keys[key]}")
-        sound = pygame.mixer.Sound(effect.filename)
-        sound.set_volume(effect.volume)
+        sound = self.load_effect(effect)
         self._keys[key].append(effect)
         self._effects[effect] = sound
     
     def remove_effect(self, effect: Effect):
-        if effect not in self._effect:
+        if effect not in self._effects:
             raise SoundError(f"Cannot remove {effect.filename!r}. Effect not found.")
         del self._effects[effect]
-        k = effect.key.lower if self.ignore_case else effect.key
+        k = effect.key.lower() if self.ignore_case else effect.key
         ix = self._keys[k].index(effect)
         self._keys[k].pop(ix)
     
@@ -102,8 +336,6 @@ class SoundBoard:
             raise SoundError(f"Invalid volume ({ambient.volume}) for {ambient.filename!r}")
         if ambient.fade_in < 0:
             raise SoundError(f"Invalid fade_in ({ambient.fade_in} ms) for {ambient.filename!r}")
-        if not os.access(ambient.filename, mode=os.R_OK):
-            raise SoundError(f"File not found: {ambient.filename!r}")
 
         if ambient.key is not None:
             key = ambient.key.lower() if self.ignore_case else ambient.key
@@ -115,6 +347,9 @@ class SoundBoard:
                 if isinstance(snd, Ambient):
                     raise SoundError(f"Error: Multiple ambient sounds assigned to {ambient.key!r}")
             self._keys[key].append(ambient)
+        if ambient.mode is not None:
+            self._modes.setdefault(ambient.mode, ambient)
+            self._playlists[ambient.mode].append(ambient)
         self._ambients.append(ambient)
 
     def remove_ambient(self, ambient: Ambient):
@@ -124,19 +359,382 @@ class SoundBoard:
         self._ambients.pop(ix)
 
         if ambient.key:
-            k = ambient.key.lower if self.ignore_case else ambient.key
+            k = ambient.key.lower() if self.ignore_case else ambient.key
             ix = self._keys[k].index(ambient)
             self._keys[k].pop(ix)
+        if ambient.mode is not None:
+            playlist = self._playlists[ambient.mode]
+            playlist.remove(ambient)
+            if playlist:
+                self._modes[ambient.mode] = playlist[0]
+            else:
+                del self._playlists[ambient.mode]
+                self._modes.pop(ambient.mode, None)
+        self._buffers.pop(ambient.filename, None)
+
+    def index_modes(self, modes: set):
+        """Fill in the mode -> ambient map for ambients without a mode.
+
+        Older configs didn't have a mode so the ambient whose filename starts
+        with the mode name (e.g. dragon_background.mp3) is used.
+        """
+        self._mode_names = tuple(modes)
+        for ambient in self._ambients:
+            fn = os.path.split(ambient.filename)[-1]
+            for mode in modes:
+                if fn.startswith(mode) and mode not in self._modes:
+                    self._modes[mode] = ambient
+
+    def reload(self, config: 'BoardConfig', loaded: dict = None, stale: set = ()) -> dict:
+        """Switch to a new config without stopping what's playing.
+
+        Only the effects that changed get loaded, unless they're already in
+        loaded (effect -> Sound, e.g. from a Reloader thread).  An effect
+        that only changed its volume or such keeps its old Sound, so if it's
+        playing it carries on at the new volume.  Files in stale changed on
+        disk and are always read again.
+
+        The new effect, key and mode tables are built on the side and then
+        swapped in together, so a key press gets either the old sounds or
+        the new ones.  Returns what changed (see diff_config()).
+        """
+        voices = len(self.pool.channels) if self.pool else 0
+        if config.channels != len(self.channels) or config.voices != voices:
+            raise SoundError(f"Changing from {len(self.channels)} channels and {voices} voices to "
+                             f"{config.channels} and {config.voices} needs a restart")
+        if self.config and config.mixer != self.config.mixer:
+            raise SoundError("Changing the mixer settings needs a restart")
+        if self.pool:
+            self.pool.steal = config.steal
+        old = self.config or BoardConfig(len(self.channels), self.ignore_case, self.crossfade,
+                                         ambients=tuple(self._ambients),
+                                         effects=tuple(self._effects),
+                                         voices=voices)
+        diff = diff_config(old, config, stale)
+        loaded = loaded or {}
+
+        # Reuse the Sound of a removed effect if the same file comes back
+        reusable = defaultdict(list)
+        for effect in diff['effects_removed']:
+            if effect.filename not in stale:
+                reusable[effect.filename].append(self._effects[effect])
+
+        effects = dict()
+        for effect in config.effects:
+            if effect in self._effects and effect not in diff['effects_added']:
+                effects[effect] = self._effects[effect]
+            elif effect in loaded:
+                effects[effect] = loaded[effect]
+            elif reusable[effect.filename]:
+                sound = reusable[effect.filename].pop()
+                sound.set_volume(effect.volume)
+                effects[effect] = sound
+            else:
+                effects[effect] = self.load_effect(effect)
+
+        fold = (lambda k: k.lower()) if config.ignore_case else (lambda k: k)
+        keys = defaultdict(list)
+        playlists = defaultdict(list)
+        for ambient in config.ambients:
+            if ambient.key is not None:
+                keys[fold(ambient.key)].append(ambient)
+            if ambient.mode is not None:
+                playlists[ambient.mode].append(ambient)
+        modes = {mode: playlist[0] for mode, playlist in playlists.items()}
+        for effect in config.effects:
+            keys[fold(effect.key)].append(effect)
+
+        # Swap everything over in one go
+        self._effects, self._keys, self._modes = effects, keys, modes
+        if self.pool:
+            self.pool.remap(edited_effects(diff, fold))
+        self._playlists = playlists
+        self.shuffle = config.shuffle
+        self._ambients = list(config.ambients)
+        self.control_keys = dict(config.control_keys)
+        self.ignore_case = config.ignore_case
+        self.crossfade = config.crossfade
+        self.volume_ramp = config.volume_ramp
+        self.ducking = config.ducking
+        self.config = config
+        self.index_modes(self._mode_names)
+
+        for ambient in diff['ambients_removed']:
+            self._buffers.pop(ambient.filename, None)
+        for filename in stale:
+            self._buffers.pop(filename, None)
+
+        # Keep the music going but pick up its new settings.  The pending
+        # ambient (if any) is switched the same way.
+        if self.current_ambient in diff['ambients_removed']:
+            self.current_ambient = self._replacement(self.current_ambient)
+            if self.current_ambient:
+                pygame.mixer.music.set_volume(self._music_volume(self.current_ambient))
+        if self._pending and self._pending[1] in diff['ambients_removed']:
+            ambient = self._replacement(self._pending[1])
+            self._pending = (self._pending[0], ambient) if ambient else None
+        # A track already handed to the mixer can't be taken back, but one
+        # still being read in is picked again from the new playlist.
+        if self._queued is not None and not self._queue_sent:
+            self._queue_next()
+
+        if config.prefetch:
+            self.prefetch()
+        return diff
+
+    def _replacement(self, ambient: Ambient) -> Ambient:
+        # The new version of an ambient is the one with the same mode, or
+        # key, or file, in that order
+        for match in ('mode', 'key', 'filename'):
+            value = getattr(ambient, match)
+            if value is None:
+                continue
+            for new in self._ambients:
+                if getattr(new, match) == value:
+                    return new
+        return None
+
+    def mode_ambient(self, mode: str) -> Ambient:
+        playlist = self._playlists.get(mode)
+        if not playlist or len(playlist) == 1:
+            return self._modes.get(mode, None)
+        return self._next_track(playlist, self._last.get(mode))
+
+    def playlist(self, ambient: Ambient) -> list:
+        """The ambients that take turns with this one (empty if it's on its own)."""
+        playlist = self._playlists.get(ambient.mode, ()) if ambient and ambient.mode else ()
+        return playlist if len(playlist) > 1 and ambient in playlist else []
+
+    def _next_track(self, playlist: list, current: Ambient) -> Ambient:
+        if self.shuffle:
+            # Anything but the one that just played
+            return random.choice([a for a in playlist if a != current] or playlist)
+        if current not in playlist:
+            return playlist[0]
+        return playlist[(playlist.index(current) + 1) % len(playlist)]
+
+    def _read_ahead(self, ambient: Ambient):
+        # Read the next track in on a thread so queueing it never waits on
+        # the SD card.  update() queues it once it's there.
+        def read():
+            try:
+                with open(ambient.filename, 'rb') as fp:
+                    self._buffers[ambient.filename] = fp.read()
+                logger.info(f"Read ahead {ambient.filename}")
+            except OSError as e:
+                logger.warning(f"Could not read ahead {ambient.filename}: {e}")
+                self._buffers[ambient.filename] = None
+
+        threading.Thread(target=read, name="ambient-read-ahead", daemon=True).start()
+
+    def _queue_next(self):
+        # Line up the track after the current one
+        self._queued, self._queue_sent = None, False
+        playlist = self.playlist(self.current_ambient)
+        if not playlist:
+            return
+        self._queued = self._next_track(playlist, self.current_ambient)
+        if self._queued.filename not in self._buffers:
+            self._read_ahead(self._queued)
+        self._send_queued()
+
+    def _send_queued(self):
+        ambient = self._queued
+        if ambient is None or self._queue_sent or ambient.filename not in self._buffers:
+            return
+        data = self._buffers[ambient.filename]
+        logger.info(f"Queueing ambient sound: {ambient.filename}")
+        try:
+            if data is not None:
+                pygame.mixer.music.queue(io.BytesIO(data), ambient.filename, loops=max(0, ambient.loops))
+            else:
+                pygame.mixer.music.queue(ambient.filename, loops=max(0, ambient.loops))
+        except pygame.error as e:
+            logger.warning(f"Could not queue {ambient.filename}: {e}")
+            self._queued = None
+            return
+        self._queue_sent = True
+
+    def _track_changed(self):
+        # The queued track has taken over from the old one.  The old one can
+        # be gone if a reload took it out of the config.
+        old, ambient = self.current_ambient, self._queued
+        if ambient not in self._ambients:
+            # Reloaded since it was queued
+            ambient = self._replacement(ambient) or ambient
+        logger.info(f"Now playing ambient sound: {ambient.filename}")
+        self.current_ambient = ambient
+        self._last[ambient.mode] = ambient
+        pygame.mixer.music.set_volume(self._music_volume(ambient))
+        if (self.config is not None and not self.config.prefetch and old is not None
+                and old.filename != ambient.filename):
+            self._buffers.pop(old.filename, None)
+        self._started(ambient)
+        self._queue_next()
+
+    def prefetch(self):
+        """Read all of the ambient files into memory on a background thread."""
+        def read_all(ambients):
+            for ambient in ambients:
+                if ambient.filename in self._buffers:
+                    continue
+                try:
+                    with open(ambient.filename, 'rb') as fp:
+                        self._buffers[ambient.filename] = fp.read()
+                    logger.info(f"Prefetched {ambient.filename}")
+                except OSError as e:
+                    logger.warning(f"Could not prefetch {ambient.filename}: {e}")
+
+        self._prefetcher = threading.Thread(target=read_all, args=(list(self._ambients),),
+                                            name="ambient-prefetch", daemon=True)
+        self._prefetcher.start()
     
-    def play_ambient(self, ambient: Ambient):
+    def _started(self, snd: Union[Ambient, Effect], since: float = None):
+        if self.bus is not None and snd.light is not None:
+            self.bus.publish('light_cue', snd.light, since)
+
+    def play_ambient(self, ambient: Ambient, since: float = None, fade_in: int = None):
+        """Start an ambient.  If it's one of a mode's playlist the rest
+        follow it, each played once (or loops + 1 times)."""
         logger.info(f"Playing ambient sound: {ambient.filename}")
-        pygame.mixer.music.load(ambient.filename)
-        pygame.mixer.music.set_volume(ambient.volume)
-        pygame.mixer.music.play(loops=ambient.loops, fade_ms=ambient.fade_in)
+        playlist = self.playlist(ambient)
+        loops = max(0, ambient.loops) if playlist else ambient.loops
+        data = self._buffers.get(ambient.filename)
+        if data is not None:
+            pygame.mixer.music.load(io.BytesIO(data), ambient.filename)
+        else:
+            pygame.mixer.music.load(ambient.filename)
+        pygame.mixer.music.set_volume(self._music_volume(ambient))
+        fade_in = ambient.fade_in if fade_in is None else fade_in
+        pygame.mixer.music.play(loops=loops, fade_ms=fade_in)
         self.current_ambient = ambient
+        self._pending = None
+        if ambient.mode is not None:
+            self._last[ambient.mode] = ambient
+        self._music_pos = -1
+        self._queue_next()
+        self._started(ambient, since)
+
+    def switch_ambient(self, ambient: Ambient):
+        """Change to ambient, fading the current one out first."""
+        if pygame.mixer.music.get_busy() and (ambient == self.current_ambient
+                                              or self.current_ambient in self.playlist(ambient)):
+            return
+        if self.crossfade <= 0 or not pygame.mixer.music.get_busy():
+            self.play_ambient(ambient)
+            return
+        logger.info(f"Fading out {self.current_ambient.filename if self.current_ambient else None}")
+        pygame.mixer.music.fadeout(self.crossfade // 2)
+        self._queued = None     # fadeout() drops it anyway
+        self._pending = (pygame.time.get_ticks() + self.crossfade // 2, ambient)
+
+    def update(self):
+        """Call once a frame (or on a MUSIC_END event) to start any ambient
+        waiting on a fade out and keep the playlist going."""
+        if self._pending is not None:
+            start, ambient = self._pending
+            if pygame.time.get_ticks() >= start or not pygame.mixer.music.get_busy():
+                self.play_ambient(ambient, fade_in=max(ambient.fade_in, self.crossfade // 2))
+            return
+        if self._queued is None:
+            return
+
+        # The position starts again from zero when the queued track takes over
+        pos = pygame.mixer.music.get_pos()
+        if self._queue_sent and 0 <= pos < self._music_pos:
+            self._track_changed()
+            pos = pygame.mixer.music.get_pos()
+        elif not self._queue_sent and not pygame.mixer.music.get_busy() and not self.paused:
+            # Ran out before the next one was read in.  Late is better than never.
+            if self._queued.filename in self._buffers:
+                self.play_ambient(self._queued)
+                return
+        self._music_pos = pos
+        self._send_queued()
+
+    def _music_volume(self, ambient: Ambient) -> float:
+        levels = self.levels
+        return ambient.volume * levels['master'] * levels['ambient'] * levels['duck']
 
-    def play_effect(self, effect: Effect):
+    def tick_levels(self) -> bool:
+        """Move the volume ramps along and push any changes to the mixer.
+
+        Runs on the ramp timer.  Returns True while there's more to do.
+        """
+        ducked = False
+        if self.ducking:
+            # A reload can swap the effects table in at any time, so this
+            # works from the one it finds and is_playing() copes with an
+            # effect that's gone.
+            effects = self._effects
+            ducked = any(self.is_playing(e) for e in list(effects) if e.duck)
+            target = self.ducking.level if ducked else 1.0
+            if self.levels.target('duck') != target:
+                ms = self.ducking.attack if ducked else self.ducking.release
+                self.levels.ramp('duck', target, ms)
+
+        changed = self.levels.tick()
+        if changed & {'master', 'ambient', 'duck'} and self.current_ambient:
+            pygame.mixer.music.set_volume(self._music_volume(self.current_ambient))
+        master = 'master' in changed
+        for ix, ch in enumerate(self.all_channels):
+            if master or f"gain{ix}" in changed:
+                ch.set_volume(self.levels['master'] * self.levels[f"gain{ix}"])
+        return self.levels.active or ducked
+
+    def set_volume(self, level: float, ms: int = None):
+        """Ramp the master volume to level (0 - 1) over ms."""
+        self.levels.ramp('master', max(0.0, min(1.0, level)), self.volume_ramp if ms is None else ms)
+        self._timer.kick()
+
+    def set_gain(self, channel: int, level: float, ms: int = None):
+        """Ramp one channel's volume (before the master) to level over ms."""
+        self.levels.ramp(f"gain{channel}", max(0.0, min(1.0, level)),
+                         self.volume_ramp if ms is None else ms)
+        self._timer.kick()
+
+    def set_ambient_level(self, level: float, ms: int = None):
+        """Ramp the ambient (before the master) to level over ms."""
+        self.levels.ramp('ambient', max(0.0, min(1.0, level)), self.volume_ramp if ms is None else ms)
+        self._timer.kick()
+
+    def play_pooled(self, effect: Effect, sound: pygame.mixer.Sound) -> bool:
+        # Same rules as a fixed channel, but an effect can have up to
+        # polyphony copies going at once before it restarts (or stops) the
+        # oldest one.
+        playing = self.pool.playing(effect)
+        if len(playing) >= effect.polyphony:
+            oldest = playing[0]
+            if effect.retrigger:
+                logger.info(f"Restarting effect: {effect.filename}")
+                self.pool.play(oldest, effect, sound)
+                return True
+            logger.info(f"Stopping effect: {effect.filename}")
+            for ix in playing:
+                self.pool.channels[ix].stop()
+            return False
+
+        ix = self.pool.allocate(effect)
+        if ix is None:
+            return False
+        logger.info(f"Playing effect: {effect.filename} on voice {ix}")
+        self.pool.play(ix, effect, sound)
+        return True
+
+    def play_effect(self, effect: Effect, since: float = None) -> bool:
+        """Start (or stop) an effect.  Returns True if the effect was started."""
         sound = self._effects[effect]
+        if effect.channel is None:
+            started = self.play_pooled(effect, sound)
+        else:
+            started = self.play_fixed(effect, sound)
+        if started:
+            self._started(effect, since)
+            if effect.duck and self.ducking:
+                self._timer.kick()
+        return started
+
+    def play_fixed(self, effect: Effect, sound: pygame.mixer.Sound) -> bool:
         chan = self.channels[effect.channel]
         loops = effect.loops
 
@@ -149,6 +747,7 @@ class SoundBoard:
                 else:                   # Stop the effect
                     logger.info(f"Stopping effect: {effect.filename}")
                     chan.stop()
+                    return False
             else:   # Stop the old effect on this channel and start a new one
                 logger.info(f"Playing new effect: {effect.filename}")
                 chan.stop()
@@ -156,6 +755,7 @@ class SoundBoard:
         else: # Start playing an effect
             logger.info(f"Playing effect: {effect.filename}")
             chan.play(sound, loops=loops, fade_ms=effect.fade_in)
+        return True
 
     def start(self):
         self.start_ambient(True)
@@ -170,54 +770,55 @@ class SoundBoard:
     def stop(self):
         pygame.mixer.music.stop()
         self.current_ambient = None
+        self._pending = None
+        self._queued = None
 
-        for ch in self.channels:
+        for ch in self.all_channels:
             ch.stop()
         logger.info("All sounds stopped")
 
     def volume(self, delta: float):
+        # Go from where the last press was heading so quick presses add up
         logger.info(f"Changing volume by {delta:.2f}")
-        
-        if pygame.mixer.music.get_busy():   # Ambient is playing
-            max_volume = self.current_ambient.volume
-            target_volume = pygame.mixer.music.get_volume() + delta
-            vol = max(0, min(target_volume, max_volume))
-            pygame.mixer.music.set_volume(vol)
-            # logger.info(f"Ambient sound volume: {vol:.2f}")
-
-        for ix, ch in enumerate(self.channels):
-            target_volume = ch.get_volume() + delta
-            vol = max(0, min(target_volume, 1.0))
-            ch.set_volume(vol)
-            # logger.info(f"Channel {ix} volume: {vol:.2f}")
+        self.set_volume(self.levels.target('master') + delta)
 
     def pause(self):
         if not self.paused:
             pygame.mixer.music.pause()
-            for ch in self.channels:
+            for ch in self.all_channels:
                 ch.pause()
             logger.info("All sounds paused")
         else:
             pygame.mixer.music.unpause()
-            for ch in self.channels:
+            for ch in self.all_channels:
                 ch.unpause()
             logger.info("All sounds resumed")
         self.paused = not self.paused
 
     def is_playing(self, snd: Union[Ambient, Effect]) -> bool:
         if isinstance(snd, Effect):
+            if snd.channel is None:
+                return bool(self.pool.playing(snd))
             ch = snd.channel
             if self.channels[ch].get_busy():
-                return self.channels[ch].get_sound() == self._effects[snd]
+                sound = self._effects.get(snd)
+                return sound is not None and self.channels[ch].get_sound() == sound
             return False
         elif isinstance(snd, Ambient):
             if pygame.mixer.music.get_busy():
                 return snd == self.current_ambient
             return False
         else:
-            raise TypeError("Cannot check if {type(snd)} is playing.")
+            raise TypeError(f"Cannot check if {type(snd)} is playing.")
         
-    def key_press(self, key: str) -> list:
+    def key_press(self, key: str, pressed: float = None) -> list:
+        """Play (or stop) whatever is on key.
+
+        pressed is when the key was pressed (time.perf_counter()) if it
+        wasn't just now.  It's used for the light cue and the keypress to
+        sound latency stats.
+        """
+        pressed = time.perf_counter() if pressed is None else pressed
         k = key.lower() if self.ignore_case else key
         if k in self.control_keys:
             action = self.control_keys[k]
@@ -239,59 +840,427 @@ class SoundBoard:
         playing = []
         for sound in self._keys[k]:
             if isinstance(sound, Ambient):
-                self.play_ambient(sound)
+                self.play_ambient(sound, pressed)
                 playing.append(sound)
             elif isinstance(sound, Effect):
-                self.play_effect(sound)
+                self.play_effect(sound, pressed)
                 playing.append(sound)
 
+        if playing:
+            self.latency.add((time.perf_counter() - pressed) * 1000 + self.output_latency)
         return playing
+
+    def latency_report(self) -> str:
+        return f"{self.latency.report()} (includes {self.output_latency:.1f} ms mixer buffer)"
     
-def load_json(config_filename: str, 
-              logging_level: int = logging.CRITICAL) -> SoundBoard:
-    with open(config_filename, 'r') as fp:
-        cfg = json.load(fp)
-
-        channels = int(cfg['player'].get('channels', DEFAULT_CHANNELS))
-        ignore_case = bool(cfg['player'].get('ignore_case', DEFAULT_IGNORE_CASE))
-        board = SoundBoard(channels, ignore_case, logging_level)
-
-        for action in ('stop_key', 'pause_key', 'volume_up', 'volume_down'):
-            if action in cfg['player']:
-                key = cfg['player'][action].lower() if ignore_case else cfg['player'][action]
-                if key in board.control_keys:
-                    raise SoundError("Sound action {board.control_keys[key]!r} alreadys assigned to {key!r}")
-                board.control_keys[key] = action                
-
-        for music in cfg.get('ambients', []):
-            if 'filename' not in music:
-                raise SoundError("Config Error: Missing filename in ambient sounds.")
-            ambient = Ambient(music['filename'],
-                              music.get('key', None),
-                              music.get('autostart', False),
-                              music.get('loops', -1),
-                              music.get('volume', 1.0),
-                              music.get('fade_in', 0)
-                             )
-            board.add_ambient(ambient)
-
-        for sound in cfg.get('effects', []):
-            for required in ('filename', 'channel', 'key'):
-                if required not in sound:
-                    raise SoundError("Config Error: Missing {required} in effect sounds")
-
-            effect = Effect(sound['filename'],
-                            sound['channel'],
-                            sound['key'],
-                            sound.get('loops', 0),
-                            sound.get('retrigger', False),
-                            sound.get('volume', 1.0),
-                            sound.get('fade_in', 0),
-                           )
-            board.add_effect(effect)
-    
+CONTROL_ACTIONS = ('stop_key', 'pause_key', 'volume_up', 'volume_down')
+
+# Bump this when the schema or the compiled classes change so old caches
+# get thrown away.
+CACHE_VERSION = 7
+
+LIGHT_SCHEMA = Schema({
+    'cue': Field(str, required=True, check=one_of(LIGHT_CUES)),
+    'duration': Field(int, default=0, check=at_least(0)),
+    'mode': Field(str),
+})
+
+MIXER_SCHEMA = Schema({
+    'frequency': Field(int, default=DEFAULT_MIXER['frequency'], check=one_of((22050, 32000, 44100, 48000))),
+    'size': Field(int, default=DEFAULT_MIXER['size'], check=one_of((8, -8, 16, -16, 32))),
+    'channels': Field(int, default=DEFAULT_MIXER['channels'], check=between(1, 2)),
+    'buffer': Field(int, default=DEFAULT_MIXER['buffer'], check=power_of_two(32, 8192)),
+})
+
+VOICE_POOL_SCHEMA = Schema({
+    'voices': Field(int, required=True, check=between(1, 64)),
+    'steal': Field(str, default=DEFAULT_STEAL, check=one_of(STEAL_ORDERS)),
+})
+
+DUCKING_SCHEMA = Schema({
+    'level': Field(float, default=Ducking.level, check=between(0.0, 1.0)),
+    'attack': Field(int, default=Ducking.attack, check=at_least(0)),
+    'release': Field(int, default=Ducking.release, check=at_least(0)),
+})
+
+PLAYER_SCHEMA = Schema({
+    'channels': Field(int, default=DEFAULT_CHANNELS, check=at_least(1)),
+    'ignore_case': Field(bool, default=DEFAULT_IGNORE_CASE),
+    'crossfade': Field(int, default=DEFAULT_CROSSFADE, check=at_least(0)),
+    'prefetch': Field(bool, default=DEFAULT_PREFETCH),
+    'voice_pool': Field(dict, schema=VOICE_POOL_SCHEMA),
+    'mixer': Field(dict, schema=MIXER_SCHEMA),
+    'volume_ramp': Field(int, default=DEFAULT_VOLUME_RAMP, check=at_least(0)),
+    'ducking': Field(dict, schema=DUCKING_SCHEMA),
+    'shuffle': Field(bool, default=False),
+    **{action: Field(str) for action in CONTROL_ACTIONS},
+})
+
+AMBIENT_SCHEMA = Schema({
+    'filename': Field(str, required=True),
+    'key': Field(str),
+    'autostart': Field(bool, default=False),
+    'loops': Field(int, default=-1, check=at_least(-1)),
+    'volume': Field(float, default=1.0, check=between(0.0, 1.0)),
+    'fade_in': Field(int, default=0, check=at_least(0)),
+    'light': Field(dict, schema=LIGHT_SCHEMA),
+    'mode': Field(str),
+})
+
+EFFECT_SCHEMA = Schema({
+    'filename': Field(str, required=True),
+    'channel': Field(int, check=at_least(0)),    # None for the voice pool
+    'key': Field(str, required=True),
+    'loops': Field(int, default=0, check=at_least(-1)),
+    'retrigger': Field(bool, default=False),
+    'volume': Field(float, default=1.0, check=between(0.0, 1.0)),
+    'fade_in': Field(int, default=0, check=at_least(0)),
+    'light': Field(dict, schema=LIGHT_SCHEMA),
+    'priority': Field(int, default=0),
+    'polyphony': Field(int, default=1, check=between(1, 64)),
+    'duck': Field(bool, default=False),
+})
+
+# Settings for the boat's animations.  These are picked up on the next
+# frame when the config is reloaded.
+ANIMATION_SCHEMA = Schema({
+    'rail_level': Field(int, check=between(0, 255)),
+    'rail_decay': Field(int, check=between(1, 255)),
+    'rail_prob': Field(float, check=between(0.0, 1.0)),
+    'wave_level': Field(int, check=between(0, 255)),
+})
+
+BOARD_SCHEMA = Schema({
+    'player': Field(dict, default={}, schema=PLAYER_SCHEMA),
+    'animation': Field(dict, default={}, schema=ANIMATION_SCHEMA),
+    'ambients': Field(list, default=[], items=AMBIENT_SCHEMA),
+    'effects': Field(list, default=[], items=EFFECT_SCHEMA),
+})
+
+# A checked config, ready to build a SoundBoard from.  Everything in here is
+# immutable so it can be cached and compared.
+@dataclass(frozen=True)
+class BoardConfig:
+    channels: int = DEFAULT_CHANNELS
+    ignore_case: bool = DEFAULT_IGNORE_CASE
+    crossfade: int = DEFAULT_CROSSFADE
+    prefetch: bool = DEFAULT_PREFETCH
+    control_keys: tuple = ()        # ((key, action), ...)
+    ambients: tuple = ()
+    effects: tuple = ()
+    animation: tuple = ()           # ((setting, value), ...) for Boat.configure()
+    voices: int = DEFAULT_VOICES
+    steal: str = DEFAULT_STEAL
+    mixer: tuple = ()               # ((setting, value), ...) for pygame.mixer.init()
+    volume_ramp: int = DEFAULT_VOLUME_RAMP
+    ducking: Ducking = None
+    shuffle: bool = False
+
+def make_light(values: dict) -> LightCue:
+    if values is None:
+        return None
+    return LightCue(values['cue'], values['duration'], values['mode'])
+
+def compile_config(cfg: dict, base_dir: str = '') -> BoardConfig:
+    """Check a sound board config and turn it into a BoardConfig.
+
+    Every problem is collected and raised together in one SchemaError.
+    Filenames are checked relative to base_dir.
+    """
+    values, errors = BOARD_SCHEMA.validate(cfg)
+    player = values['player'] or PLAYER_SCHEMA.validate({})[0]
+    pool = player['voice_pool'] or dict(voices=DEFAULT_VOICES, steal=DEFAULT_STEAL)
+    ignore_case = player['ignore_case']
+    fold = (lambda k: k.lower()) if ignore_case else (lambda k: k)
+
+    control_keys = {}
+    for action in CONTROL_ACTIONS:
+        if player[action] is None:
+            continue
+        key = fold(player[action])
+        if key in control_keys:
+            errors.append(f"player.{action}: {key!r} already assigned to {control_keys[key]!r}")
+        control_keys[key] = action
+
+    def check_sound(where, entry):
+        if entry['filename'] is not None:
+            if not os.access(os.path.join(base_dir, entry['filename']), mode=os.R_OK):
+                errors.append(f"{where}.filename: file not found: {entry['filename']!r}")
+        if entry['key'] is not None and fold(entry['key']) in control_keys:
+            errors.append(f"{where}.key: {entry['key']!r} already in use for "
+                          f"{control_keys[fold(entry['key'])]!r}")
+        light = entry['light']
+        if light is not None and light['cue'] == 'mode' and light['mode'] is None:
+            errors.append(f"{where}.light.mode: missing for a 'mode' cue")
+
+    ambients = []
+    ambient_keys = {}
+    for ix, music in enumerate(values['ambients'] or []):
+        if music is None:
+            continue        # Not an object, already reported
+        where = f"ambients[{ix}]"
+        check_sound(where, music)
+        if music['key'] is not None:
+            if fold(music['key']) in ambient_keys:
+                errors.append(f"{where}.key: multiple ambient sounds assigned to {music['key']!r}")
+            ambient_keys[fold(music['key'])] = music['filename']
+        ambients.append(Ambient(music['filename'],
+                                music['key'],
+                                music['autostart'],
+                                music['loops'],
+                                music['volume'],
+                                music['fade_in'],
+                                make_light(music['light']),
+                                music['mode'],
+                               ))
+
+    effects = []
+    for ix, sound in enumerate(values['effects'] or []):
+        if sound is None:
+            continue
+        where = f"effects[{ix}]"
+        check_sound(where, sound)
+        if sound['channel'] is not None and sound['channel'] >= player['channels']:
+            errors.append(f"{where}.channel: must be less than {player['channels']} channels "
+                          f"(got {sound['channel']})")
+        if sound['channel'] is None and not pool['voices']:
+            errors.append(f"{where}.channel: missing (and there's no player.voice_pool)")
+        if sound['channel'] is not None and sound['polyphony'] > 1:
+            errors.append(f"{where}.polyphony: only works without a channel (voice pool)")
+        effects.append(Effect(sound['filename'],
+                              sound['channel'],
+                              sound['key'],
+                              sound['loops'],
+                              sound['retrigger'],
+                              sound['volume'],
+                              sound['fade_in'],
+                              make_light(sound['light']),
+                              sound['priority'],
+                              sound['polyphony'],
+                              sound['duck'],
+                             ))
+
+    if errors:
+        raise SchemaError(errors)
+
+    animation = values['animation'] or {}
+    return BoardConfig(player['channels'],
+                       ignore_case,
+                       player['crossfade'],
+                       player['prefetch'],
+                       tuple(control_keys.items()),
+                       tuple(ambients),
+                       tuple(effects),
+                       tuple((k, v) for k, v in animation.items() if v is not None),
+                       pool['voices'],
+                       pool['steal'],
+                       tuple((player['mixer'] or {}).items()),
+                       player['volume_ramp'],
+                       Ducking(**player['ducking']) if player['ducking'] else None,
+                       player['shuffle'],
+                      )
+
+def edited_effects(diff: dict, fold=lambda k: k) -> dict:
+    """Pair up the effects diff_config() says were removed with the ones
+    added in their place (old -> new).  An effect is the same one edited if
+    it's on the same key, and if the key has more than one, the same file.
+    """
+    added = defaultdict(list)
+    for effect in diff['effects_added']:
+        added[fold(effect.key)].append(effect)
+    edited = {}
+    for effect in diff['effects_removed']:
+        candidates = added.get(fold(effect.key), [])
+        if len(candidates) > 1:
+            candidates = [e for e in candidates if e.filename == effect.filename]
+        if len(candidates) == 1:
+            edited[effect] = candidates[0]
+    return edited
+
+def diff_config(old: BoardConfig, new: BoardConfig, stale: set = ()) -> dict:
+    """What changed between two configs.
+
+    Entries are frozen so anything edited shows up as removed from the old
+    config and added in the new one.  Entries whose files are in stale
+    count as changed even if the config entry is the same.
+    """
+    def split(old_entries, new_entries):
+        old_entries, new_entries = set(old_entries), set(new_entries)
+        touched = {e for e in old_entries & new_entries if e.filename in stale}
+        return new_entries - old_entries | touched, old_entries - new_entries | touched
+
+    effects_added, effects_removed = split(old.effects, new.effects)
+    ambients_added, ambients_removed = split(old.ambients, new.ambients)
+    player = [name for name in ('ignore_case', 'crossfade', 'prefetch', 'control_keys', 'shuffle')
+              if getattr(old, name) != getattr(new, name)]
+    return dict(effects_added=effects_added,
+                effects_removed=effects_removed,
+                ambients_added=ambients_added,
+                ambients_removed=ambients_removed,
+                player=player,
+                animation=old.animation != new.animation)
+
+def file_stamps(config: BoardConfig, base_dir: str = '') -> tuple:
+    """(filename, size, mtime) of every sound file in a config.  None for
+    the ones that can't be read."""
+    stamps = []
+    for entry in config.ambients + config.effects:
+        if entry.filename is None:
+            continue
+        try:
+            st = os.stat(os.path.join(base_dir, entry.filename))
+            stamps.append((entry.filename, st.st_size, st.st_mtime_ns))
+        except OSError:
+            stamps.append((entry.filename, None, None))
+    return tuple(stamps)
+
+def load_config(config_filename: str, use_cache: bool = True) -> BoardConfig:
+    """Load and compile a config, using the cached copy if nothing changed.
+
+    The cache sits next to the config and is keyed on a hash of the config
+    file and the directory the sound files are found from, so booting with
+    the same config skips the parsing, checking and poking around the file
+    system.  The size and modification time of every sound file are kept
+    with it and a file that's changed or gone means checking again.
+    """
+    with open(config_filename, 'rb') as fp:
+        raw = fp.read()
+    # Sound filenames are relative to the current directory
+    base_dir = os.path.abspath('')
+    digest = hashlib.sha256(raw + b'\0' + os.fsencode(base_dir)).hexdigest()
+    cache_filename = config_filename + '.cache'
+
+    if use_cache:
+        try:
+            with open(cache_filename, 'rb') as fp:
+                version, cached_digest, stamps, config = pickle.load(fp)
+            if version == CACHE_VERSION and cached_digest == digest:
+                if stamps == file_stamps(config, base_dir):
+                    logger.info(f"Using cached config {cache_filename!r}")
+                    return config
+                logger.info(f"Sound files changed since {cache_filename!r} was made")
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError, AttributeError, TypeError):
+            pass
+
+    try:
+        cfg = json.loads(raw)
+    except ValueError as e:
+        raise SoundError(f"Config Error: {config_filename!r} isn't valid JSON: {e}")
+    try:
+        config = compile_config(cfg)
+    except SchemaError as e:
+        raise SoundError(str(e))
+
+    if use_cache:
+        try:
+            with open(cache_filename, 'wb') as fp:
+                pickle.dump((CACHE_VERSION, digest, file_stamps(config, base_dir), config), fp)
+        except OSError as e:
+            logger.warning(f"Could not write config cache {cache_filename!r}: {e}")
+    return config
+
+def board_from_config(config: BoardConfig,
+                      logging_level: int = logging.CRITICAL) -> SoundBoard:
+    board = SoundBoard(config.channels, config.ignore_case, logging_level, config.crossfade,
+                       config.voices, config.steal, dict(config.mixer),
+                       config.volume_ramp, config.ducking, config.shuffle)
+    board.config = config
+    board.control_keys.update(config.control_keys)
+    for ambient in config.ambients:
+        board.add_ambient(ambient)
+    for effect in config.effects:
+        board.add_effect(effect)
+    if config.prefetch:
+        board.prefetch()
     return board
 
+def load_json(config_filename: str, 
+              logging_level: int = logging.CRITICAL,
+              use_cache: bool = True) -> SoundBoard:
+    return board_from_config(load_config(config_filename, use_cache), logging_level)
+
+class Reloader:
+    """Watches a config (and the sound files in it) for changes.
+
+    The new config is checked and any new sounds are loaded on a background
+    thread.  The main loop calls poll() and hands what it gets back to
+    SoundBoard.reload(), which is quick, so the lights and sounds don't
+    miss a beat.  A broken config is reported and otherwise ignored.
+    """
+    def __init__(self, board: SoundBoard, config_filename: str, use_inotify: bool = True):
+        import watch        # Only needed if you want reloads
+        if board.config is None:
+            raise SoundError("Can only reload a board made from a config file")
+        self.board = board
+        self.config_filename = config_filename
+        self.watcher = watch.FileWatcher(self._files(board.config), use_inotify)
+        self.ready = None
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="config-reload", daemon=True)
+
+    def _files(self, config: BoardConfig) -> list:
+        files = [self.config_filename]
+        if config is not None:
+            files += [snd.filename for snd in config.ambients + config.effects]
+        return files
+
+    def start(self) -> None:
+        logger.info(f"Watching {self.config_filename!r} for changes ({self.watcher.method})")
+        self._thread.start()
+
+    def _run(self) -> None:
+        config = self.board.config
+        while not self._stop.is_set():
+            changed = self.watcher.wait()
+            if not changed:
+                continue
+            stale = {f for f in changed if f != os.path.abspath(self.config_filename)}
+            stale = {snd.filename for snd in config.ambients + config.effects
+                     if os.path.abspath(snd.filename) in stale}
+            try:
+                new = load_config(self.config_filename)
+                loaded = self._preload(config, new, stale)
+            except (SoundError, OSError, pygame.error) as e:
+                self.errors += 1
+                print(f"Not reloading {self.config_filename!r}: {e}", flush=True)
+                continue
+            with self._lock:
+                # Still waiting on the last one?  Roll the two together.
+                if self.ready is not None:
+                    _, old_loaded, old_stale = self.ready
+                    loaded = {**{e: s for e, s in old_loaded.items() if e.filename not in stale},
+                              **loaded}
+                    stale = stale | old_stale
+                self.ready = (new, loaded, stale)
+            self.watcher.watch(self._files(new))
+            config = new
+
+    def _preload(self, old: BoardConfig, new: BoardConfig, stale: set) -> dict:
+        # Load the effects reload() can't get from the old ones.  Nothing
+        # here touches the board's tables.
+        diff = diff_config(old, new, stale)
+        reusable = [e.filename for e in diff['effects_removed'] if e.filename not in stale]
+        loaded = dict()
+        for effect in diff['effects_added']:
+            if effect.filename in reusable:
+                reusable.remove(effect.filename)
+            else:
+                loaded[effect] = self.board.load_effect(effect)
+        return loaded
+
+    def poll(self):
+        """(config, loaded, stale) for SoundBoard.reload() if a reload is ready."""
+        with self._lock:
+            ready, self.ready = self.ready, None
+        return ready
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join(timeout=2 * self.watcher.interval)
+        self.watcher.close()
+
 def test_board(json_file: str):
     from pprint import pprint
 
@@ -0,0 +1,79 @@
+import time
+import threading
+
+from contextlib import contextmanager
+
+# Near enough to when the program started, as long as this is imported
+# before anything heavy
+STARTED = time.perf_counter()
+
+# Probably overkill
+import logging
+logger = logging.getLogger("[Startup]")
+
+class StartupTrace:
+    """Records how long each part of starting up takes.
+
+    Phases can overlap (e.g. loading sounds on a thread while the display
+    comes up) so each one keeps its own start and end, measured from when
+    the program started.
+    """
+    def __init__(self, started: float = STARTED):
+        self.started = started
+        self.phases = []        # (name, start ms, end ms, thread name)
+        self.marks = []         # (name, ms)
+        self._lock = threading.Lock()
+
+    def add(self, name: str, start: float, end: float) -> None:
+        with self._lock:
+            self.phases.append((name, (start - self.started) * 1000,
+                                (end - self.started) * 1000, threading.current_thread().name))
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter())
+
+    def mark(self, name: str) -> float:
+        """Note a milestone (like the first frame going out).  Returns its time in ms."""
+        ms = (time.perf_counter() - self.started) * 1000
+        with self._lock:
+            self.marks.append((name, ms))
+        return ms
+
+    def report(self) -> str:
+        lines = []
+        for name, start, end, thread in sorted(self.phases, key=lambda p: p[1]):
+            where = '' if thread == 'MainThread' else f"  [{thread}]"
+            lines.append(f"  {name:<16} {start:8.1f} -> {end:8.1f} ms  ({end - start:7.1f} ms){where}")
+        for name, ms in self.marks:
+            lines.append(f"  {name:<16} {ms:8.1f} ms")
+        return "Startup:\n" + "\n".join(lines)
+
+class Background:
+    """Runs fn(*args) on a thread.  result() waits for it and hands back
+    what it returned (or raises what it raised)."""
+    def __init__(self, fn, *args, name: str = None):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(fn, args), name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self, fn, args) -> None:
+        try:
+            self._result = fn(*args)
+        except BaseException as e:
+            self._error = e
+
+    @property
+    def done(self) -> bool:
+        return not self._thread.is_alive()
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
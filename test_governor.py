@@ -0,0 +1,86 @@
+import os
+
+import governor
+
+def write(root, path, text):
+    full = os.path.join(root, path)
+    os.makedirs(os.path.dirname(full), exist_ok=True)
+    with open(full, 'w') as fp:
+        fp.write(text)
+
+def stat_line(busy, idle):
+    # user nice system idle iowait irq softirq
+    return f"cpu  {busy} 0 0 {idle} 0 0 0\ncpu0 0 0 0 0 0 0 0\n"
+
+def test_cpu_is_the_busy_share_since_the_last_sample(tmp_path):
+    root = str(tmp_path)
+    monitor = governor.ResourceMonitor(root)
+    write(root, governor.PROC_STAT, stat_line(100, 900))
+    assert monitor.read_cpu() is None       # Nothing to compare with yet
+    write(root, governor.PROC_STAT, stat_line(175, 925))
+    assert abs(monitor.read_cpu() - 0.75) < 1e-9
+    write(root, governor.PROC_STAT, stat_line(175, 925))
+    assert monitor.read_cpu() is None       # No time has passed
+
+def test_missing_and_bad_files_read_as_none(tmp_path):
+    root = str(tmp_path)
+    monitor = governor.ResourceMonitor(root)
+    sample = monitor.sample()
+    assert (sample.cpu, sample.temp, sample.throttled) == (None, None, None)
+    assert sample.describe() == 'nothing to read'
+
+    write(root, governor.PROC_STAT, "intr 12 34\n")
+    write(root, governor.THERMAL_ZONE, "hot\n")
+    write(root, governor.GET_THROTTLED, "throttled=0x5\n")
+    sample = monitor.sample()
+    assert (sample.cpu, sample.temp, sample.throttled) == (None, None, None)
+
+    write(root, governor.THERMAL_ZONE, "71250\n")
+    write(root, governor.GET_THROTTLED, "0x50005\n")
+    sample = monitor.sample()
+    assert sample.temp == 71.25
+    assert sample.throttled == 0x50005
+    assert governor.throttle_names(sample.throttled) == ['under-voltage', 'throttled']
+
+def test_degrade_and_restore_take_their_time(tmp_path):
+    root = str(tmp_path)
+    monitor = governor.ResourceMonitor(root)
+    gov = governor.Governor(monitor)
+
+    def poll(temp, now):
+        write(root, governor.THERMAL_ZONE, f"{int(temp * 1000)}\n")
+        monitor.sample()
+        return gov.poll(now=now)
+
+    # Hot, but not for long enough
+    assert poll(80, 0.0) is None
+    assert poll(80, 1.0) is None
+    # Somewhere in between starts the clock again
+    assert poll(70, 1.5) is None
+    assert poll(80, 2.0) is None
+    assert poll(80, 3.0) is None
+    assert poll(80, 4.0).name == 'no preview'
+    # Every step down has to wait again
+    assert poll(80, 5.0) is None
+    assert poll(80, 6.0) is None
+    assert poll(80, 7.0).name == 'half rate'
+    assert gov.level == 2
+
+    # Cool, but coming back up is slow
+    assert poll(60, 8.0) is None
+    assert poll(60, 8.0 + governor.RESTORE_AFTER - 1) is None
+    assert poll(60, 8.0 + governor.RESTORE_AFTER).name == 'no preview'
+    assert [d[1:3] for d in gov.decisions] == [('full', 'no preview'),
+                                               ('no preview', 'half rate'),
+                                               ('half rate', 'no preview')]
+
+def test_late_frames_count_as_pressure(tmp_path):
+    monitor = governor.ResourceMonitor(str(tmp_path))
+    gov = governor.Governor(monitor)
+    for _ in range(governor.FRAME_WINDOW):
+        gov.frame(30.0, 20.0)
+    monitor.sample()
+    assert gov.poll(now=0.0) is None
+    monitor.sample()
+    assert gov.poll(now=governor.DEGRADE_AFTER).name == 'no preview'
+    assert gov.frames.overrun == 0.0        # Starts again at the new level
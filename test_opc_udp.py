@@ -0,0 +1,59 @@
+import opc_udp
+
+def bridge_and_frames():
+    bridge = opc_udp.Bridge(('127.0.0.1', 0), ('127.0.0.1', 9))
+    bridge.sock.settimeout(1.0)
+    forwarded = []
+    bridge._forward = forwarded.append
+    return bridge, forwarded
+
+def pump(bridge, count):
+    for _ in range(count):
+        datagram, sender = bridge.sock.recvfrom(65535)
+        bridge.receive(datagram, sender)
+
+def test_restarted_client_is_forwarded():
+    bridge, forwarded = bridge_and_frames()
+    address = '127.0.0.1:%d' % bridge.sock.getsockname()[1]
+
+    old = opc_udp.DatagramClient(address)
+    for _ in range(50):
+        old.put_pixels([(255, 0, 0)] * 4)
+    pump(bridge, 50)
+    old.disconnect()
+    assert len(forwarded) == 50
+
+    # Numbers from 1 again, on a new port
+    new = opc_udp.DatagramClient(address)
+    new.put_pixels([(0, 255, 0)] * 4)
+    pump(bridge, 1)
+    new.disconnect()
+    assert len(forwarded) == 51
+    assert forwarded[-1].endswith(bytes([0, 255, 0]) * 4)
+    assert bridge.stats['resets'] == 1
+
+def test_same_sender_restart_after_idle():
+    bridge, forwarded = bridge_and_frames()
+    header = opc_udp.HEADER.pack(opc_udp.MAGIC, 100, 0, 1, 0) + opc_udp.OPC_HEADER.pack(0, 0, 3)
+    bridge.receive(header + b'\x01\x02\x03', ('10.0.0.2', 5000), now=10.0)
+    restart = opc_udp.HEADER.pack(opc_udp.MAGIC, 1, 0, 1, 0) + opc_udp.OPC_HEADER.pack(0, 0, 3)
+    bridge.receive(restart + b'\x04\x05\x06', ('10.0.0.2', 5000), now=10.1)
+    assert len(forwarded) == 1      # Still stale while the old one is fresh
+    bridge.receive(restart + b'\x04\x05\x06', ('10.0.0.2', 5000), now=10.1 + opc_udp.IDLE_RESET + 1)
+    assert len(forwarded) == 2
+
+def test_server_down_drops_frames_without_retrying_each_one():
+    bridge = opc_udp.Bridge(('127.0.0.1', 0), ('127.0.0.1', 9))
+    for seq in range(1, 51):
+        header = opc_udp.HEADER.pack(opc_udp.MAGIC, seq, 0, 1, 0) + opc_udp.OPC_HEADER.pack(0, 0, 3)
+        bridge.receive(header + b'\x01\x02\x03', ('10.0.0.2', 5000))
+    assert bridge.stats['forwarded'] == 0
+    assert bridge.stats['disconnected'] == 50
+    assert bridge.retry_at > 0
+
+def test_client_looks_up_names_off_thread():
+    client = opc_udp.DatagramClient('localhost:7890')
+    assert not client.put_pixels([(1, 2, 3)])   # Still looking it up
+    client._lookup.join(timeout=5.0)
+    assert client.put_pixels([(1, 2, 3)])
+    client.disconnect()
@@ -0,0 +1,60 @@
+import numpy as np
+
+# Probably overkill
+import logging
+logger = logging.getLogger("[Upsample]")
+
+DEFAULT_OUTPUT_RATE = 100
+
+class Upsampler:
+    """Smooths out low frame rate animations on the way to the LEDs.
+
+    The animation hands over keyframes at whatever rate the mode runs at and
+    the output asks for frames at a much higher fixed rate.  Each output
+    frame is a straight line blend from where the LEDs were when the last
+    keyframe came in to that keyframe, taking as long as the gap between
+    the last two keyframes.  That costs one keyframe of latency but it's all
+    numpy so the per frame cost is tiny compared to running the animation.
+
+    This is the same trick the Fade Candy firmware does, but it works with
+    any OPC server.
+    """
+    def __init__(self, rate: int = DEFAULT_OUTPUT_RATE):
+        if rate <= 0:
+            raise ValueError(f"Invalid output rate ({rate})")
+        self.rate = rate
+        self.period = max(1, int(1000 / rate))     # ms
+
+        self._start = None      # Where the blend starts from
+        self._target = None     # The newest keyframe
+        self._key_time = None   # ms
+        self._duration = self.period
+        self._current = None
+
+        self.keyframes = 0
+        self.frames = 0
+
+    def add_keyframe(self, pixels: list, now: int) -> None:
+        frame = np.asarray(pixels, dtype=np.float32).reshape(-1, 3)
+        if self._target is None or frame.shape != self._target.shape:
+            self._start = frame
+            self._duration = self.period
+        else:
+            self._start = self._current if self._current is not None else self._target
+            self._duration = max(self.period, now - self._key_time)
+        self._target = frame
+        self._key_time = now
+        self.keyframes += 1
+
+    def frame(self, now: int) -> list:
+        """The pixels to show at time now (ms), ready for put_pixels()."""
+        if self._target is None:
+            return []
+        alpha = min(1.0, max(0.0, (now - self._key_time) / self._duration))
+        self._current = self._start + (self._target - self._start) * alpha
+        self.frames += 1
+        return np.rint(self._current).astype(np.uint8).tolist()
+
+    def report(self) -> str:
+        ratio = self.frames / self.keyframes if self.keyframes else 0.0
+        return f"{self.frames} frames from {self.keyframes} keyframes ({ratio:.1f} per keyframe)"
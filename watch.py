@@ -0,0 +1,171 @@
+import os
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# Probably overkill
+import logging
+logger = logging.getLogger("[Watch]")
+
+# How often to look at the files when there's no inotify (seconds)
+POLL_INTERVAL = 1.0
+
+# Editors tend to write a file in a few steps (write a temp file, rename it,
+# fix up the permissions...) so wait this long for things to settle before
+# saying anything changed (seconds).
+SETTLE_TIME = 0.2
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ATTRIB
+EVENT = struct.Struct('iIII')
+
+class WatchError(Exception): pass
+
+class Inotify:
+    """Just enough inotify, through ctypes so there's nothing to install.
+
+    Directories are watched rather than the files themselves because most
+    editors save by renaming a new file over the old one, which would
+    leave a watch on the file pointing at nothing.
+    """
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise WatchError("No inotify on this system")
+        self._libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatchError(f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+        self._dirs = dict()     # wd -> directory
+
+    def add(self, directory: str) -> None:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            raise WatchError(f"Can't watch {directory!r}: {os.strerror(ctypes.get_errno())}")
+        self._dirs[wd] = directory
+
+    def read(self, timeout: float) -> set:
+        """Paths that had something happen to them, or an empty set on timeout."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+
+        paths = set()
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if wd in self._dirs and name:
+                paths.add(os.path.join(self._dirs[wd], os.fsdecode(name)))
+        return paths
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+        self.fd = -1
+
+class FileWatcher:
+    """Tells you which of a set of files changed.
+
+    Uses inotify when it can and falls back to checking modification times
+    every POLL_INTERVAL seconds when it can't (or when asked not to).
+    """
+    def __init__(self, paths: list, use_inotify: bool = True, interval: float = POLL_INTERVAL):
+        self.interval = interval
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = Inotify()
+            except (OSError, WatchError) as e:
+                logger.info(f"Polling for changes: {e}")
+        self.paths = set()
+        self._stamps = dict()
+        self.watch(paths)
+
+    @property
+    def method(self) -> str:
+        return 'inotify' if self.inotify else 'polling'
+
+    def watch(self, paths: list) -> None:
+        """Change the set of files being watched."""
+        paths = {os.path.abspath(p) for p in paths}
+        if self.inotify:
+            watched = {os.path.dirname(p) for p in self.paths}
+            for directory in {os.path.dirname(p) for p in paths} - watched:
+                try:
+                    self.inotify.add(directory)
+                except WatchError as e:
+                    logger.warning(str(e))
+        self.paths = paths
+        self._stamps = {p: self._stamp(p) for p in paths}
+
+    @staticmethod
+    def _stamp(path: str) -> tuple:
+        try:
+            st = os.stat(path)
+            return (st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _poll(self) -> set:
+        changed = set()
+        for path in self.paths:
+            stamp = self._stamp(path)
+            if stamp != self._stamps.get(path):
+                self._stamps[path] = stamp
+                changed.add(path)
+        return changed
+
+    def wait(self, timeout: float = None) -> set:
+        """Block for up to timeout seconds.  Returns the files that changed."""
+        timeout = self.interval if timeout is None else timeout
+        if self.inotify:
+            if not self.inotify.read(timeout) & self.paths:
+                return set()
+            # Soak up the rest of the save then see what really changed
+            while self.inotify.read(SETTLE_TIME):
+                pass
+            return self._poll()
+
+        end = time.monotonic() + timeout
+        while True:
+            changed = self._poll()
+            if changed:
+                time.sleep(SETTLE_TIME)
+                return changed | self._poll()
+            left = end - time.monotonic()
+            if left <= 0:
+                return set()
+            time.sleep(min(self.interval, left))
+
+    def close(self) -> None:
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    watcher = FileWatcher(sys.argv[1:])
+    print(f"Watching {len(watcher.paths)} files ({watcher.method})")
+    try:
+        while True:
+            for path in sorted(watcher.wait()):
+                print(f"Changed: {path}")
+    except KeyboardInterrupt:
+        watcher.close()